@@ -1,314 +1,210 @@
 import streamlit as st
 import zipfile
 import pandas as pd
-import openpyxl
-from openpyxl import Workbook
-from io import BytesIO
-from datetime import datetime
-import re
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from bank_merge import (
+    DEFAULT_WORKERS, MERGE_STORE_PATH, OUTPUT_FORMATS,
+    add_count, check_balance_chain, file_cache_key, metrics_report,
+    metrics_start, metrics_stop, probe_files, process_files, timer,
+)
 
 st.set_page_config(page_title="Bank File Merger v2.0 | 28/02 08:00", page_icon="🏦", layout="wide")
 
-# ── BANK PROFILES ──────────────────────────────────────────────
-def detect_bank(rows):
-    flat = ' '.join([str(c) for r in rows[:15] for c in r if c])
-    if 'BẢNG SAO KÊ GIAO DỊCH' in flat:
-        return 'ACB'
-    if 'SAO KÊ TÀI KHOẢN' in flat or 'STATEMENT OF ACCOUNT' in flat:
-        return 'VCB'
-    if 'so but toan' in flat.lower() and 'ngay giao dich' in flat.lower():
-        return 'TCB'
-    if 'VIETINBANK' in flat.upper() or 'efast' in flat.lower() or 'LỊCH SỬ GIAO DỊCH' in flat:
-        return 'VTB'
-    if 'MB BANK' in flat.upper() or 'MILITARY' in flat.upper():
-        return 'MB'
-    return None
-
-def get_account_no(rows, bank_id):
-    flat_rows = [' '.join([str(c) for c in r if c]) for r in rows[:15]]
-    if bank_id == 'ACB':
-        for line in flat_rows:
-            m = re.search(r'[Ss]ố tài khoản.*?:\s*(\d+)', line)
-            if m: return m.group(1)
-            m = re.search(r'[Tt]ài khoản số:\s*(\d+)', line)
-            if m: return m.group(1)
-    elif bank_id == 'VCB':
-        for r in rows[:10]:
-            for i, cell in enumerate(r):
-                if cell and ('tài khoản' in str(cell).lower() or 'account number' in str(cell).lower()):
-                    for j in range(i+1, len(r)):
-                        v = str(r[j] or '').strip()
-                        if re.match(r'^\d{8,}$', v): return v
-                    m = re.search(r'\d{8,}', str(cell))
-                    if m: return m.group(0)
-    elif bank_id == 'TCB':
-        if len(rows) > 1 and len(rows[1]) > 1:
-            return str(rows[1][1] or '').strip()
-    elif bank_id in ('VTB', 'MB'):
-        for r in rows[:15]:
-            for i, cell in enumerate(r):
-                if cell and ('account no' in str(cell).lower() or 'số tài khoản' in str(cell).lower()):
-                    if i+1 < len(r):
-                        m = re.search(r'\d{8,}', str(r[i+1] or ''))
-                        if m: return m.group(0)
-    return 'unknown'
-
-def find_header_row(rows, bank_id):
-    kws = {
-        'ACB': ['ngày hiệu lực', 'số gd'],
-        'VCB': ['debit', 'credit'],
-        'TCB': ['so but toan', 'no/debit'],
-        'VTB': ['accounting date', 'debit'],
-        'MB':  ['ngày giao dịch', 'số tiền'],
-    }
-    keywords = kws.get(bank_id, [])
-    for i, row in enumerate(rows):
-        # Normalize: replace newlines + tabs → space trước khi so sánh
-        flat = ' '.join([str(c or '').replace('\n',' ').replace('\t',' ').lower() for c in row])
-        if all(kw in flat for kw in keywords):
-            return i
-    return -1
-
-def parse_amount(val):
-    """Normalize số: xóa dấu . và , phân cách nghìn → số nguyên"""
-    if val is None or str(val).strip() == '': return 0
-    s = str(val).strip()
-    # Xóa chữ VND và ký tự không phải số ở cuối (VD: "21,991,508 VND")
-    s = re.sub(r'[A-Za-z\s]+$', '', s).strip()
-    if not s: return 0
-    # Xóa tất cả dấu chấm và phẩy (VN dùng . hoặc , để phân cách nghìn)
-    s = re.sub(r'[,\.]', '', s)
-    try:
-        return int(float(s))
-    except:
-        return 0
-
-def parse_date(val):
-    """Parse date từ nhiều format"""
-    if not val: return None
-    s = str(val).strip().split('\n')[0]  # VCB merged cell
-    # Nếu là datetime object (openpyxl trả về datetime)
-    if hasattr(val, 'year'): return val
-    patterns = [
-        r'^(\d{1,2})/(\d{1,2})/(\d{4})',           # dd/mm/yyyy
-        r'^(\d{1,2})/(\d{1,2})/(\d{4})\s+\d{1,2}:\d{2}', # dd/mm/yyyy HH:MM
-        r'^(\d{4})-(\d{2})-(\d{2})',                 # yyyy-mm-dd
-        r'^(\d{1,2})-(\d{1,2})-(\d{4})',             # dd-mm-yyyy
-        r'^(\d{1,2})-(\d{1,2})-(\d{4})\s+\d{1,2}:\d{2}', # dd-mm-yyyy HH:MM:SS
-    ]
-    for p in patterns:
-        m = re.match(p, s)
-        if m:
-            g = m.groups()
-            try:
-                if len(g[0]) == 4:  # yyyy-mm-dd
-                    return datetime(int(g[0]), int(g[1]), int(g[2]))
-                else:
-                    return datetime(int(g[2]), int(g[1]), int(g[0]))
-            except:
-                continue
-    return None
-
-def get_dedup_key(row, headers, bank_id, account_no):
-    """Tạo key để dedup"""
-    h = [str(h or '').lower() for h in headers]
-
-    # Tìm Số GD / reference
-    ref = ''
-    for kw in ['số gd', 'so but toan', 'số giao dịch', 'reference', 'số tham chiếu']:
-        for i, hh in enumerate(h):
-            if kw in hh and i < len(row):
-                ref = str(row[i] or '').strip()
-                break
-        if ref: break
-
-    # Tìm ngày
-    date_str = ''
-    for kw in ['ngày giao dịch', 'ngay giao dich', 'ngày hạch toán', 'transaction date']:
-        for i, hh in enumerate(h):
-            if kw in hh and i < len(row):
-                date_str = str(row[i] or '').strip()
-                break
-        if date_str: break
-    if not date_str and len(row) > 0:
-        date_str = str(row[0] or '').strip()
-
-    # Tìm số tiền
-    amounts = []
-    for kw in ['tiền', 'debit', 'credit', 'nợ', 'có', 'rút', 'gửi', 'no/', 'co/']:
-        for i, hh in enumerate(h):
-            if kw in hh and i < len(row):
-                v = parse_amount(row[i])
-                if v > 0: amounts.append(str(v))
-
-    if ref:
-        return f"{bank_id}_{account_no}_{ref}"
-    else:
-        return f"{bank_id}_{account_no}_{date_str}_{'|'.join(amounts)}"
-
-def normalize_row(row, headers):
-    """Normalize số trong row"""
-    result = []
-    h = [str(h or '').lower() for h in headers]
-    for i, cell in enumerate(row):
-        col_name = h[i] if i < len(h) else ''
-        is_amount = any(kw in col_name for kw in [
-            'tiền', 'nợ', 'có', 'debit', 'credit', 'dư', 'balance',
-            'rút', 'gửi', 'no/', 'co/', 'amount'
-        ])
-        if is_amount:
-            result.append(parse_amount(cell))
-        else:
-            result.append(str(cell) if cell is not None else '')
-    return result
-
-def read_file(uploaded_file):
-    """Đọc file xlsx/xls/csv → list of rows"""
-    name = uploaded_file.name.lower()
-    if name.endswith('.csv'):
-        # Auto-detect separator: thử ; trước rồi ,
-        raw = uploaded_file.read()
-        # Detect encoding (handle BOM)
-        for enc in ['utf-8-sig', 'utf-8', 'latin-1', 'cp1252']:
-            try:
-                text = raw.decode(enc)
-                break
-            except:
-                continue
-        # Parse thủ công từng dòng để tránh lỗi pandas với file có số cột không đều
-        lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
-        rows = []
-        for line in lines:
-            if not line.strip():
-                rows.append([])
-                continue
-            # Detect separator từ dòng có nhiều field nhất
-            sep = ';' if line.count(';') > line.count(',') else ','
-            # Parse thủ công handle quoted fields
-            cols = []
-            cur = ''
-            in_q = False
-            for ch in line:
-                if ch == '"':
-                    in_q = not in_q
-                elif ch == sep and not in_q:
-                    cols.append(cur.strip())
-                    cur = ''
-                else:
-                    cur += ch
-            cols.append(cur.strip())
-            rows.append(cols)
-        return rows
-    elif name.endswith('.xls'):
-        # Format cũ Excel 97-2003 → dùng xlrd
-        import xlrd
-        wb = xlrd.open_workbook(file_contents=uploaded_file.read())
-        ws = wb.sheet_by_index(0)
-        rows = []
-        for i in range(ws.nrows):
-            rows.append([ws.cell_value(i, j) for j in range(ws.ncols)])
-        return rows
-    else:
-        wb = openpyxl.load_workbook(uploaded_file, data_only=True)
-        ws = wb.active
-        rows = []
-        for row in ws.iter_rows(values_only=True):
-            rows.append(list(row))
-        return rows
-
-def process_files(files_by_group):
-    """Merge + dedup files theo nhóm"""
-    results = {}
-    for key, info in files_by_group.items():
-        bank_id = info['bank_id']
-        account_no = info['account_no']
-        all_rows_data = info['files']  # list of (rows, filename)
-
-        if not all_rows_data:
-            continue
-
-        # Lấy header từ file đầu tiên
-        first_rows = all_rows_data[0][0]
-        h_idx = find_header_row(first_rows, bank_id)
-        if h_idx < 0:
-            results[key] = {'error': f'Không tìm thấy header row trong file {all_rows_data[0][1]}'}
+# ── INSTRUMENTATION (UI) ───────────────────────────────────────
+def render_diagnostics(m, name):
+    """Panel diagnostics: bảng timer + counter, tải JSON run report"""
+    if not m: return
+    report = metrics_report(m)
+    with st.expander("🔬 Diagnostics", expanded=False):
+        st.dataframe(pd.DataFrame([
+            {'stage': k, 'seconds': v['seconds'], 'calls': v['calls'],
+             'µs / call': round(v['seconds'] / v['calls'] * 1e6, 1) if v['calls'] else None}
+            for k, v in report['timers'].items()]), hide_index=True, use_container_width=True)
+        if report['counts']:
+            st.dataframe(pd.DataFrame(list(report['counts'].items()), columns=['counter', 'value']),
+                         hide_index=True, use_container_width=True)
+        st.download_button("⬇️ Tải run report (JSON)",
+                           data=json.dumps(report, ensure_ascii=False, indent=2),
+                           file_name=f"run_report_{name}.json", mime="application/json",
+                           key=f"dl_report_{name}")
+
+# ── PARSE CACHE + PARALLEL INGEST ──────────────────────────────
+PARSE_CACHE_ENTRIES = 256   # số FileProfile giữ lại (LRU)
+
+@st.cache_resource
+def _parse_cache():
+    """LRU dùng chung mọi session, sống qua các lần rerun"""
+    return {'lock': threading.Lock(), 'entries': OrderedDict()}
+
+def parse_cache_get(key):
+    cache = _parse_cache()
+    with cache['lock']:
+        profile = cache['entries'].get(key)
+        if profile is not None:
+            cache['entries'].move_to_end(key)
+        return profile
+
+def parse_cache_put(key, profile):
+    cache = _parse_cache()
+    with cache['lock']:
+        cache['entries'][key] = profile
+        cache['entries'].move_to_end(key)
+        while len(cache['entries']) > PARSE_CACHE_ENTRIES:
+            cache['entries'].popitem(last=False)
+
+def probe_uploads(files, workers=1):
+    """Nhận dạng list (file, cache_key): trúng cache thì dùng lại,
+    file còn lại probe song song bằng ProcessPoolExecutor khi workers > 1.
+    Trả về list (profile, lỗi) theo đúng thứ tự đầu vào."""
+    out = []
+    misses = []
+    for i, (f, key) in enumerate(files):
+        profile = parse_cache_get(key)
+        out.append((profile, None))
+        if profile is None:
+            misses.append(i)
+    add_count('probe.cache_hit', len(files) - len(misses))
+    add_count('probe.cache_miss', len(misses))
+
+    done = probe_files([files[i][0] for i in misses], workers)
+
+    for i, (profile, err) in zip(misses, done):
+        out[i] = (profile, err)
+        if profile is not None:
+            parse_cache_put(files[i][1], profile)
+    return out
+
+# ── RESULT STORE (spill ra đĩa) ─────────────────────────────────
+# Thư mục riêng (0700): bảng giao dịch lưu bằng pickle, đọc lại bằng pd.read_pickle —
+# user khác ghi được vào đây là chạy được code trong app. Mặc định: mkdtemp riêng cho
+# process; đặt RESULT_STORE_DIR thì thư mục phải thuộc user đang chạy app.
+RESULT_STORE_DIR = os.environ.get('RESULT_STORE_DIR')
+RESULT_TTL_SECONDS = 2 * 3600          # file không ai đụng tới quá lâu → xoá
+RESULT_MAX_BYTES = 2 * 1024 ** 3       # tổng dung lượng tối đa, vượt thì xoá file cũ nhất (LRU)
+
+def _private_dir(path):
+    """Tạo / siết quyền thư mục kết quả về 0700; thuộc user khác → từ chối"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.stat(path)
+    if info.st_uid != os.getuid():
+        raise RuntimeError(f"RESULT_STORE_DIR {path} không thuộc user đang chạy app")
+    if info.st_mode & 0o077:
+        os.chmod(path, 0o700)
+    return path
+
+@st.cache_resource
+def _result_store():
+    """Thư mục + lock dùng chung mọi session trong process"""
+    path = _private_dir(RESULT_STORE_DIR) if RESULT_STORE_DIR else tempfile.mkdtemp(prefix='bank_merge_results_')
+    return {'dir': path, 'lock': threading.Lock()}
+
+def _result_path(handle):
+    if os.path.basename(handle) != handle:
+        raise ValueError(f"Handle không hợp lệ: {handle!r}")
+    return os.path.join(_result_store()['dir'], handle)
+
+def result_evict(keep=None):
+    """Xoá file quá TTL rồi xoá file cũ nhất (theo mtime) cho tới khi dưới RESULT_MAX_BYTES.
+    keep: handle vừa ghi, không bao giờ bị xoá"""
+    entries = []
+    total = 0
+    for name in os.listdir(_result_store()['dir']):
+        try:
+            info = os.stat(_result_path(name))
+        except FileNotFoundError:
             continue
-
-        meta_rows = first_rows[:h_idx]
-        header_row = first_rows[h_idx]
-        headers = header_row
-
-        # Gom tất cả data rows
-        seen = set()
-        all_data = []
-        total_input = 0
-        dup_count = 0
-
-        for rows, fname in all_rows_data:
-            this_h = find_header_row(rows, bank_id)
-            if this_h < 0: continue
-
-            for row in rows[this_h+1:]:
-                # Bỏ qua row rỗng
-                flat = ''.join([str(c or '') for c in row]).strip()
-                if not flat: continue
-
-                # Check có ngày hợp lệ không - tìm trong các col đầu
-                d = None
-                for _ci in range(min(5, len(row))):
-                    d = parse_date(row[_ci])
-                    if d: break
-                if not d: continue
-
-                total_input += 1
-
-                # Dedup
-                dk = get_dedup_key(row, headers, bank_id, account_no)
-                if dk in seen:
-                    dup_count += 1
-                    continue
-                seen.add(dk)
-
-                # Normalize
-                clean_row = normalize_row(row, headers)
-                all_data.append((d, clean_row))
-
-        # Sort theo ngày tăng dần
-        all_data.sort(key=lambda x: x[0])
-
-        if not all_data:
-            results[key] = {'error': 'Không có data sau khi lọc'}
+        total += info.st_size
+        if name != keep:
+            entries.append((info.st_mtime, info.st_size, name))
+    entries.sort()
+    now = time.time()
+    evicted = 0
+    for mtime, size, name in entries:
+        if now - mtime < RESULT_TTL_SECONDS and total <= RESULT_MAX_BYTES:
+            break
+        try:
+            os.remove(_result_path(name))
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted += 1
+    add_count('result_store.evicted', evicted)
+
+def result_put(write, suffix=''):
+    """Ghi 1 kết quả ra đĩa → handle (tên file). write(f) ghi nội dung vào file nhị phân f"""
+    handle = uuid.uuid4().hex + suffix
+    with _result_store()['lock']:
+        with open(_result_path(handle), 'wb') as f:
+            write(f)
+        result_evict(keep=handle)
+    return handle
+
+def result_path(handle):
+    """Đường dẫn file của handle (chạm mtime cho LRU), None nếu đã bị xoá"""
+    path = _result_path(handle)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+def result_read(handle):
+    """Đọc nội dung từ đĩa — gọi lúc user bấm tải (download_button data=callable)"""
+    path = result_path(handle)
+    if path is None:
+        raise FileNotFoundError(f"Kết quả merge đã hết hạn ({handle})")
+    with open(path, 'rb') as f:
+        return f.read()
+
+def result_drop(handles):
+    for handle in handles:
+        try:
+            os.remove(_result_path(handle))
+        except FileNotFoundError:
+            pass
+
+def spill_results(results):
+    """Kết quả process_files → metadata + handle: file xuất và bảng giao dịch
+    ghi ra đĩa, session_state chỉ giữ phần nhỏ"""
+    out = {}
+    for key, res in results.items():
+        if 'error' in res:
+            out[key] = res
             continue
-
-        # Date range cho tên file
-        min_date = all_data[0][0]
-        max_date = all_data[-1][0]
-        fname = f"{bank_id}_{account_no}_{min_date.strftime('%d%m%Y')}to{max_date.strftime('%d%m%Y')}.xlsx"
-
-        # Build output workbook
-        wb_out = Workbook()
-        ws_out = wb_out.active
-        for r in meta_rows:
-            ws_out.append([c if c is not None else '' for c in r])
-        ws_out.append([c if c is not None else '' for c in header_row])
-        for _, row in all_data:
-            ws_out.append(row)
-
-        buf = BytesIO()
-        wb_out.save(buf)
-        buf.seek(0)
-
-        results[key] = {
-            'filename': fname,
-            'data': buf,
-            'tx_count': len(all_data),
-            'dup_removed': dup_count,
-            'total_input': total_input,
-            'date_from': min_date.strftime('%d/%m/%Y'),
-            'date_to': max_date.strftime('%d/%m/%Y'),
-        }
-
-    return results
+        res = dict(res)
+        buf = res.pop('data')
+        tx_table = res.pop('tx_table')
+        with timer('result_store.spill'):
+            res['data_handle'] = result_put(lambda f: f.write(buf.getbuffer()), os.path.splitext(res['filename'])[1])
+            res['tx_handle'] = result_put(tx_table.to_pickle, '.pkl')
+        add_count('result_store.bytes', buf.getbuffer().nbytes)
+        buf.close()
+        out[key] = res
+    return out
+
+def result_handles(results):
+    return [h for res in (results or {}).values() for h in (res.get('data_handle'), res.get('tx_handle')) if h]
+
+def zip_results(ok_results):
+    """ZIP tất cả file đã merge: đọc thẳng từ đĩa, ZIP ghi ra file tạm rồi mới trả bytes"""
+    with tempfile.TemporaryFile() as tmp:
+        with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for res in ok_results.values():
+                path = result_path(res['data_handle'])
+                if path is None:
+                    raise FileNotFoundError(f"Kết quả merge đã hết hạn ({res['filename']})")
+                zf.write(path, res['filename'])
+        tmp.seek(0)
+        return tmp.read()
 
 # ── UI ─────────────────────────────────────────────────────────
 st.title("🏦 Bank File Merger v2.0 | 28/02 08:00")
@@ -320,28 +216,56 @@ uploaded = st.file_uploader(
     accept_multiple_files=True
 )
 
+with st.expander("⚙️ Tuỳ chọn xử lý"):
+    diagnostics = st.toggle("🔬 Đo thời gian từng bước (diagnostics)", value=False, key="diagnostics")
+    parallel_ingest = st.toggle("Nhận dạng file song song (nhiều process)", value=True,
+                                key="parallel_ingest")
+    parallel_merge = st.toggle("Merge các nhóm song song (nhiều process)", value=True,
+                               key="parallel_merge")
+    use_store = st.toggle("💽 Merge tăng dần vào kho lịch sử (SQLite) — chỉ thêm giao dịch mới",
+                          value=False, key="use_store")
+    n_workers = st.slider("Số worker", 1, max(os.cpu_count() or 1, 2), DEFAULT_WORKERS,
+                          key="n_workers", disabled=not (parallel_ingest or parallel_merge))
+
 if uploaded:
     st.divider()
+    if diagnostics:
+        metrics_start()
+    else:
+        metrics_stop()
 
     # Phân nhóm file theo ngân hàng + số TK
     groups = {}
     errors = []
+    seen_digests = {}
 
     with st.spinner("🔍 Đang nhận dạng file..."):
+        files = []
         for f in uploaded:
-            try:
-                rows = read_file(f)
-                bank_id = detect_bank(rows)
-                if not bank_id:
-                    errors.append(f"❓ **{f.name}** — Không nhận dạng được ngân hàng")
-                    continue
-                account_no = get_account_no(rows, bank_id)
-                key = f"{bank_id}_{account_no}"
-                if key not in groups:
-                    groups[key] = {'bank_id': bank_id, 'account_no': account_no, 'files': []}
-                groups[key]['files'].append((rows, f.name))
-            except Exception as e:
-                errors.append(f"❌ **{f.name}** — Lỗi: {str(e)}")
+            cache_key = file_cache_key(f)
+            digest = cache_key[0]
+            if digest in seen_digests:
+                errors.append(f"♻️ **{f.name}** — Trùng nội dung với **{seen_digests[digest]}**, bỏ qua")
+                continue
+            seen_digests[digest] = f.name
+            files.append((f, cache_key))
+
+        workers = n_workers if parallel_ingest else 1
+        with timer('probe_uploads'):
+            probes = probe_uploads(files, workers)
+        for (f, _), (profile, err) in zip(files, probes):
+            if err is not None:
+                errors.append(f"❌ **{f.name}** — Lỗi: {err}")
+                continue
+            bank_id = profile['bank_id']
+            if not bank_id:
+                errors.append(f"❓ **{f.name}** — Không nhận dạng được ngân hàng")
+                continue
+            account_no = profile['account_no']
+            key = f"{bank_id}_{account_no}"
+            if key not in groups:
+                groups[key] = {'bank_id': bank_id, 'account_no': account_no, 'files': []}
+            groups[key]['files'].append((f, f.name, profile))
 
     # Hiển thị lỗi
     if errors:
@@ -366,12 +290,31 @@ if uploaded:
 
     st.divider()
 
+    output_format = st.radio(
+        "💾 Định dạng file xuất",
+        list(OUTPUT_FORMATS.keys()),
+        format_func=lambda k: OUTPUT_FORMATS[k]['label'],
+        horizontal=True,
+        key="output_format"
+    )
+
     # Nút merge
     if st.button("⚡ Merge & Dedup tất cả", type="primary", use_container_width=True):
-        with st.spinner("⏳ Đang xử lý..."):
-            results = process_files(groups)
+        merge_bar = st.progress(0.0, text=f"⏳ Đang merge {len(groups)} nhóm...")
+
+        def _on_merge_progress(key, done, total):
+            merge_bar.progress(done / total, text=f"✔️ {key} ({done}/{total} nhóm)")
 
-        # Lưu vào session_state để Phase 2 dùng được
+        with timer('process_files'):
+            results = process_files(groups, output_format,
+                                    workers=n_workers if parallel_merge else 1,
+                                    on_progress=_on_merge_progress,
+                                    store_path=MERGE_STORE_PATH if use_store else None)
+        merge_bar.empty()
+
+        # Spill file xuất + bảng giao dịch ra đĩa; session_state chỉ giữ handle + metadata
+        result_drop(result_handles(st.session_state.get('merge_results')))
+        results = spill_results(results)
         st.session_state.merge_results = results
 
         st.success(f"✅ Hoàn tất! {len(results)} file đã được tạo")
@@ -380,15 +323,9 @@ if uploaded:
         # Nút Download All - zip tất cả file
         ok_results = {k:v for k,v in results.items() if 'error' not in v}
         if len(ok_results) > 1:
-            zip_buf = BytesIO()
-            with zipfile.ZipFile(zip_buf, 'w', zipfile.ZIP_DEFLATED) as zf:
-                for k, r in ok_results.items():
-                    r['data'].seek(0)
-                    zf.writestr(r['filename'], r['data'].read())
-            zip_buf.seek(0)
             st.download_button(
                 label=f"⬇️ Tải tất cả ({len(ok_results)} file) — ZIP",
-                data=zip_buf,
+                data=lambda: zip_results(ok_results),
                 file_name="bank_merged_all.zip",
                 mime="application/zip",
                 type="primary",
@@ -409,26 +346,36 @@ if uploaded:
                     f"✅ {res['tx_count']} giao dịch | "
                     f"🗑️ Bỏ {res['dup_removed']} trùng | "
                     f"📅 {res['date_from']} → {res['date_to']}"
+                    + (f" | 🧮 index dedup {res['dedup_bytes'] / 1e6:.1f} MB" if 'dedup_bytes' in res else '')
                 )
+                if 'new_rows' in res:
+                    st.caption(f"💽 +{res['new_rows']} giao dịch mới vào kho · "
+                               f"bỏ qua {res['skipped_files']} file đã merge trước đó")
             with col2:
                 st.download_button(
                     label="⬇️ Tải về",
-                    data=res['data'],
+                    data=lambda h=res['data_handle']: result_read(h),
                     file_name=res['filename'],
-                    mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                    mime=res['mime'],
                     key=f"dl_{key}"
                 )
 
+        render_diagnostics(metrics_stop(), 'merge')
+
 
 # ═══════════════════════════════════════════════════════════
 # PHASE 2 — KẾT NỐI GOOGLE SHEETS + DUYỆT LỆNH
 # ═══════════════════════════════════════════════════════════
-import json
+import math
+import random
 from google.oauth2.service_account import Credentials
 import gspread
+from gspread.utils import a1_to_rowcol, rowcol_to_a1
 
 SPREADSHEET_ID = '1ykPA0eFSJKjcK1ofRA4ZFD5YtqoWHgfzFnCoWXysSUU'
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+# '' = Google Sheets thật; 'fake:<file.json>?latency=..&quota=..&error_rate=..' = backend giả cục bộ (fake_gsheet.py)
+GSHEET_BACKEND = os.environ.get('GSHEET_BACKEND', '')
 
 # Các sheet KHÔNG phải dự án
 NON_PROJECT_SHEETS = [
@@ -452,8 +399,11 @@ RAW_TO_ACCOUNT = {
 }
 
 def connect_gsheet(creds_json):
-    """Kết nối Google Sheets từ credentials JSON"""
+    """Kết nối Google Sheets từ credentials JSON (hoặc backend giả theo GSHEET_BACKEND)"""
     try:
+        if GSHEET_BACKEND.startswith('fake'):
+            import fake_gsheet
+            return fake_gsheet.open_backend(GSHEET_BACKEND), None
         creds = Credentials.from_service_account_info(creds_json, scopes=SCOPES)
         client = gspread.authorize(creds)
         spreadsheet = client.open_by_key(SPREADSHEET_ID)
@@ -476,124 +426,40 @@ def get_project_sheets(spreadsheet):
                and not s.lower().startswith('raw_')]
     return project
 
-def get_sheet_history(spreadsheet, sheet_name, max_rows=200):
-    """Lấy lịch sử data của 1 sheet để học pattern"""
-    try:
-        ws = spreadsheet.worksheet(sheet_name)
-        data = ws.get_all_values()
-        return data[-max_rows:] if len(data) > max_rows else data
-    except:
-        return []
-
-def suggest_project_sheet(description, project_sheets, spreadsheet):
-    """
-    Đề xuất sheet dự án dựa vào nội dung giao dịch
-    Logic: tìm sheet nào có nhiều keyword giống description nhất
-    """
-    if not description:
-        return project_sheets[0] if project_sheets else None
-
-    desc_words = set(description.upper().split())
-    scores = {}
-
-    for sheet_name in project_sheets:
-        history = get_sheet_history(spreadsheet, sheet_name, max_rows=100)
-        if not history:
-            scores[sheet_name] = 0
-            continue
-
-        score = 0
-        # Lấy tất cả text từ lịch sử sheet
-        all_text = ' '.join([' '.join([str(c) for c in row]) for row in history]).upper()
-
-        # Tìm keyword overlap
-        for word in desc_words:
-            if len(word) >= 4 and word in all_text:
-                score += 1
-
-        # Bonus: tên sheet xuất hiện trong description
-        if sheet_name.upper() in description.upper():
-            score += 10
-
-        scores[sheet_name] = score
-
-    # Sort theo score cao nhất
-    sorted_sheets = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-    return sorted_sheets[0][0] if sorted_sheets else project_sheets[0]
+def project_row(date_str, desc, amount):
+    """Dòng ghi vào sheet dự án (nghịch dấu với tài khoản)"""
+    return [date_str, desc, -amount]
 
-def get_account_cell(spreadsheet, raw_sheet_name):
-    """Tìm cell số dư trong sheet Account cho raw sheet tương ứng"""
-    try:
-        ws = spreadsheet.worksheet('Account')
-        data = ws.get_all_values()
-        for i, row in enumerate(data):
-            for j, cell in enumerate(row):
-                if str(cell).strip() == raw_sheet_name:
-                    # Tìm cell số tiếp theo cùng dòng có giá trị số
-                    for k in range(j+1, len(row)):
-                        v = str(row[k]).replace(',','').replace('.','').strip()
-                        if v.isdigit():
-                            # Trả về địa chỉ cell (row i+1, col k+1)
-                            col_letter = chr(65 + k)
-                            return f"{col_letter}{i+1}", float(row[k].replace(',',''))
-    except Exception as e:
-        pass
-    return None, None
-
-def append_to_raw_sheet(spreadsheet, raw_sheet_name, row_data):
-    """Append 1 dòng vào raw sheet"""
-    ws = spreadsheet.worksheet(raw_sheet_name)
-    ws.append_row(row_data, value_input_option='USER_ENTERED')
-
-def append_to_project_sheet(spreadsheet, project_sheet_name, date_str, desc, amount):
-    """Append 1 dòng vào sheet dự án (nghịch dấu với tài khoản)"""
-    ws = spreadsheet.worksheet(project_sheet_name)
-    ws.append_row([date_str, desc, -amount], value_input_option='USER_ENTERED')
-
-def update_account_balance(spreadsheet, cell_addr, delta):
-    """Cộng/trừ số dư tài khoản trong sheet Account"""
-    ws = spreadsheet.worksheet('Account')
-    current = ws.acell(cell_addr).value
-    current_val = float(str(current).replace(',','').replace('.','')) if current else 0
-    new_val = current_val + delta
-    ws.update_acell(cell_addr, new_val)
-
-def build_raw_row(tx, raw_sheet_name, spreadsheet):
-    """Build row data để append vào raw sheet, auto-map columns"""
-    try:
-        ws = spreadsheet.worksheet(raw_sheet_name)
-        header = ws.row_values(1)
-        if not header:
-            # Default: date, desc, debit, credit, balance, ref
-            return [tx.get('date',''), tx.get('desc',''),
-                    tx.get('debit',0), tx.get('credit',0),
-                    tx.get('balance',''), tx.get('ref','')]
-
-        row = []
-        for col in header:
-            col_l = col.lower().strip()
-            if any(k in col_l for k in ['ngày','date','ngay']):
-                row.append(tx.get('date',''))
-            elif any(k in col_l for k in ['nội dung','diễn giải','mô tả','desc','noi dung']):
-                row.append(tx.get('desc',''))
-            elif any(k in col_l for k in ['rút','nợ','debit','ghi nợ','chi']):
-                row.append(tx.get('debit',0))
-            elif any(k in col_l for k in ['gửi','có','credit','ghi có','thu']):
-                row.append(tx.get('credit',0))
-            elif any(k in col_l for k in ['số dư','balance','so du']):
-                row.append(tx.get('balance',''))
-            elif any(k in col_l for k in ['số gd','ref','so gd','but toan']):
-                row.append(tx.get('ref',''))
-            elif any(k in col_l for k in ['tên tk','tên tài khoản','counter name']):
-                row.append(tx.get('counter_name',''))
-            elif any(k in col_l for k in ['tk đối','tài khoản đối','counter acc']):
-                row.append(tx.get('counter_acct',''))
-            else:
-                row.append('')
-        return row
-    except:
+def build_raw_row(tx, header):
+    """Build row data để append vào raw sheet, auto-map columns theo header (row 1)"""
+    if not header:
+        # Default: date, desc, debit, credit, balance, ref
         return [tx.get('date',''), tx.get('desc',''),
-                tx.get('debit',0), tx.get('credit',0)]
+                tx.get('debit',0), tx.get('credit',0),
+                tx.get('balance',''), tx.get('ref','')]
+
+    row = []
+    for col in header:
+        col_l = col.lower().strip()
+        if any(k in col_l for k in ['ngày','date','ngay']):
+            row.append(tx.get('date',''))
+        elif any(k in col_l for k in ['nội dung','diễn giải','mô tả','desc','noi dung']):
+            row.append(tx.get('desc',''))
+        elif any(k in col_l for k in ['rút','nợ','debit','ghi nợ','chi']):
+            row.append(tx.get('debit',0))
+        elif any(k in col_l for k in ['gửi','có','credit','ghi có','thu']):
+            row.append(tx.get('credit',0))
+        elif any(k in col_l for k in ['số dư','balance','so du']):
+            row.append(tx.get('balance',''))
+        elif any(k in col_l for k in ['số gd','ref','so gd','but toan']):
+            row.append(tx.get('ref',''))
+        elif any(k in col_l for k in ['tên tk','tên tài khoản','counter name']):
+            row.append(tx.get('counter_name',''))
+        elif any(k in col_l for k in ['tk đối','tài khoản đối','counter acc']):
+            row.append(tx.get('counter_acct',''))
+        else:
+            row.append('')
+    return row
 
 # ── PHASE 2 UI ───────────────────────────────────────────────
 
@@ -602,29 +468,14 @@ BIG_ISSUE_OPTION = "⚡ Big Issue (D86 - Account)"
 BIG_ISSUE_CELL = "D86"
 BIG_ISSUE_SHEET = "Account"
 
-def update_big_issue(spreadsheet, delta):
-    """Cộng/trừ trực tiếp vào cell D86 trong sheet Account"""
-    ws = spreadsheet.worksheet(BIG_ISSUE_SHEET)
-    current = ws.acell(BIG_ISSUE_CELL).value
-    current_val = 0
-    if current:
-        s = str(current).replace(',','').replace('.','').strip()
-        try:
-            current_val = float(s)
-        except:
-            current_val = 0
-    new_val = current_val + delta
-    ws.update_acell(BIG_ISSUE_CELL, new_val)
+RAW_TAIL_ROWS = 200   # cửa sổ đầu tiên khi đọc ngược cột ref, nhân đôi nếu chưa thấy
 
 def get_last_ref_from_raw(spreadsheet, raw_sheet_name):
-    """B2: Lấy ref cuối cùng từ Raw sheet"""
+    """B2: Lấy ref cuối cùng từ Raw sheet — chỉ đọc header + cột ref từ cuối lên,
+    không kéo cả sheet về"""
     try:
         ws = spreadsheet.worksheet(raw_sheet_name)
-        all_data = ws.get_all_values()
-        if not all_data or len(all_data) < 2:
-            return None
-        
-        header = [str(c or '').lower().strip() for c in all_data[0]]
+        header = [str(c or '').lower().strip() for c in sheets_call(ws.row_values, 1)]
         ref_col_idx = -1
         for i, h in enumerate(header):
             if any(k in h for k in ['số gd', 'so gd', 'ref', 'but toan', 'transaction number', 
@@ -635,11 +486,18 @@ def get_last_ref_from_raw(spreadsheet, raw_sheet_name):
         if ref_col_idx < 0:
             return None
         
-        for row in reversed(all_data[1:]):
-            if ref_col_idx < len(row):
-                val = str(row[ref_col_idx] or '').strip()
+        col = ref_col_idx + 1
+        end = ws.row_count
+        window = RAW_TAIL_ROWS
+        while end >= 2:
+            start = max(2, end - window + 1)
+            values = sheets_call(ws.get, f"{rowcol_to_a1(start, col)}:{rowcol_to_a1(end, col)}")
+            for row in reversed(values):
+                val = str(row[0] or '').strip() if row else ''
                 if val:
                     return val
+            end = start - 1
+            window *= 2
         return None
     except:
         return None
@@ -647,21 +505,392 @@ def get_last_ref_from_raw(spreadsheet, raw_sheet_name):
 def get_account_balance_for_raw(spreadsheet, raw_sheet_name):
     """B3: Lấy số dư từ sheet Account cho raw sheet tương ứng"""
     try:
-        ws = spreadsheet.worksheet('Account')
-        data = ws.get_all_values()
-        for i, row in enumerate(data):
-            for j, cell in enumerate(row):
-                if str(cell).strip() == raw_sheet_name:
-                    for k in range(j+1, len(row)):
-                        v = str(row[k]).replace(',','').strip()
-                        v_clean = v.replace('.','')
-                        if v_clean.isdigit() or (v_clean.startswith('-') and v_clean[1:].isdigit()):
-                            return int(v_clean)
-        return None
+        _, index = load_account_index(spreadsheet)
+        entry = index.get(raw_sheet_name)
+        return int(entry['value']) if entry else None
     except:
         return None
 
+# ── SHEETS POSTING (theo lô) ───────────────────────────────────
+SHEETS_RETRY_STATUS = (429, 500, 502, 503)
+# append_rows không idempotent: 5xx có thể đến sau khi server đã ghi → retry là ghi 2 lần.
+# Chỉ 429 (bị từ chối vì quota, chưa ghi) mới an toàn để gửi lại
+SHEETS_APPEND_RETRY_STATUS = (429,)
+SHEETS_MAX_RETRIES = 5
+SHEETS_BACKOFF_BASE = 1.0     # giây, nhân đôi sau mỗi lần retry
+SHEETS_BACKOFF_MAX = 32.0
+POST_CHUNK_ROWS = 500         # số dòng tối đa / 1 lần append_rows
+SHEETS_QUOTA_PER_MIN = 60     # quota request / phút / user của Sheets API
+SHEETS_BURST = 10             # số request được bắn dồn khi bucket đầy
+SHEETS_WRITERS = 4            # số luồng ghi song song (mỗi luồng 1 sheet)
+
+def new_token_bucket(rate_per_min, burst):
+    """Token bucket: nạp rate_per_min token / phút, tối đa burst token"""
+    return {'rate': rate_per_min / 60.0, 'cap': float(burst), 'tokens': float(burst),
+            'ts': time.monotonic(), 'lock': threading.Lock()}
+
+def bucket_take(bucket):
+    """Lấy 1 token, chờ (ngoài lock) tới khi bucket nạp đủ"""
+    while True:
+        with bucket['lock']:
+            now = time.monotonic()
+            bucket['tokens'] = min(bucket['cap'], bucket['tokens'] + (now - bucket['ts']) * bucket['rate'])
+            bucket['ts'] = now
+            if bucket['tokens'] >= 1:
+                bucket['tokens'] -= 1
+                return
+            wait = (1 - bucket['tokens']) / bucket['rate']
+        time.sleep(wait)
+
+@st.cache_resource
+def sheets_bucket():
+    """Bucket dùng chung mọi session / luồng — mọi lời gọi Sheets đi qua đây"""
+    return new_token_bucket(SHEETS_QUOTA_PER_MIN, SHEETS_BURST)
+
+def sheets_call(fn, *args, retry_status=SHEETS_RETRY_STATUS, **kwargs):
+    """Gọi API Sheets qua token bucket, retry với exponential backoff (+ jitter)
+    khi dính quota / lỗi tạm thời (status trong retry_status)"""
+    delay = SHEETS_BACKOFF_BASE
+    name = f"sheets.{getattr(fn, '__name__', 'call')}"
+    for attempt in range(SHEETS_MAX_RETRIES + 1):
+        with timer('sheets.quota_wait'):
+            bucket_take(sheets_bucket())
+        try:
+            with timer(name):
+                return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            if status not in retry_status or attempt == SHEETS_MAX_RETRIES:
+                raise
+            add_count(f'{name}.retry')
+            time.sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, SHEETS_BACKOFF_MAX)
+
+def parse_sheet_number(v):
+    """Giá trị số đọc từ sheet ('1,234,567' / '1.234.567') → float, rỗng/lỗi → 0"""
+    s = str(v or '').replace(',','').replace('.','').strip()
+    try:
+        return float(s)
+    except ValueError:
+        return 0
+
+def grid_value(data, addr):
+    """Giá trị cell A1 trong lưới get_all_values (ngoài lưới → '')"""
+    r, c = a1_to_rowcol(addr)
+    if r <= len(data) and c <= len(data[r-1]):
+        return data[r-1][c-1]
+    return ''
+
+# ── ACCOUNT INDEX + LEDGER ─────────────────────────────────────
+def is_sheet_number(v):
+    """Text cell có phải số dư ('1,234,567' / '1.234.567' / '-1.000')"""
+    s = str(v or '').replace(',','').replace('.','').strip()
+    return s.isdigit() or (s.startswith('-') and s[1:].isdigit())
+
+def build_account_index(data):
+    """
+    Lưới Account (get_all_values) → index 1 lần:
+    {tên raw sheet | BIG_ISSUE_CELL: {'addr', 'text', 'value'}}
+    - tên raw sheet → cell số đầu tiên bên phải cùng dòng (lần xuất hiện đầu tiên)
+    - BIG_ISSUE_CELL → chính cell D86
+    """
+    index = {}
+    for i, row in enumerate(data):
+        for j, cell in enumerate(row):
+            name = str(cell).strip()
+            if not name or name in index or is_sheet_number(name): continue
+            for k in range(j+1, len(row)):
+                if is_sheet_number(row[k]):
+                    index[name] = {'addr': rowcol_to_a1(i+1, k+1), 'text': row[k],
+                                   'value': parse_sheet_number(row[k])}
+                    break
+    text = grid_value(data, BIG_ISSUE_CELL)
+    index[BIG_ISSUE_CELL] = {'addr': BIG_ISSUE_CELL, 'text': text, 'value': parse_sheet_number(text)}
+    return index
+
+def load_account_index(spreadsheet):
+    """Đọc sheet Account 1 lần → (worksheet, index)"""
+    ws = sheets_call(spreadsheet.worksheet, 'Account')
+    return ws, build_account_index(sheets_call(ws.get_all_values))
+
+def new_account_ledger(index):
+    """Sổ cộng dồn delta theo cell — chỉ ghi xuống sheet 1 lần ở cuối"""
+    return {'index': index, 'deltas': {}}
+
+def ledger_add(ledger, key, delta):
+    """Cộng delta vào cell của key (tên raw sheet / BIG_ISSUE_CELL); key không có trong index → False"""
+    entry = ledger['index'].get(key)
+    if not entry: return False
+    deltas = ledger['deltas']
+    deltas[entry['addr']] = deltas.get(entry['addr'], 0) + delta
+    return True
+
+def ledger_commit(ledger, ws):
+    """Ghi toàn bộ delta bằng 1 batch_update, cộng trên giá trị vừa đọc lại (batch_get)
+    chứ không phải giá trị lúc dựng index — cell bị đổi giữa chừng thì cộng tiếp trên số mới.
+    → (updates {addr: giá trị mới}, unapplied [{'cell', 'key', 'delta', 'reason'}]):
+    cell không còn là số / lỗi API thì không ghi, trả về để người dùng cộng tay."""
+    changes = {a: d for a, d in ledger['deltas'].items() if d}
+    if not changes: return {}, []
+    keys = {e['addr']: k for k, e in ledger['index'].items()}
+    unapplied = []
+
+    def skip(addr, reason):
+        unapplied.append({'cell': addr, 'key': keys.get(addr, addr), 'delta': changes[addr], 'reason': reason})
+
+    addrs = list(changes)
+    try:
+        current = sheets_call(ws.batch_get, addrs)
+    except Exception as e:
+        for addr in addrs: skip(addr, f"không đọc lại được: {e}")
+        return {}, unapplied
+    updates = {}
+    for addr, vr in zip(addrs, current):
+        now = vr[0][0] if vr and vr[0] else ''
+        if str(now) != str(ledger['index'][keys[addr]]['text']):
+            if not is_sheet_number(now):
+                skip(addr, f"cell không còn là số ({now!r})")
+                continue
+            add_count('ledger.rebased')
+        updates[addr] = parse_sheet_number(now) + changes[addr]
+    if updates:
+        try:
+            sheets_call(ws.batch_update, [{'range': a, 'values': [[v]]} for a, v in updates.items()])
+        except Exception as e:
+            for addr in updates: skip(addr, f"không ghi được: {e}")
+            return {}, unapplied
+    return updates, unapplied
+
+def post_transactions(spreadsheet, raw_sheet_name, items, on_progress=None, workers=SHEETS_WRITERS):
+    """
+    Hạch toán theo lô: items = [(tx, sheet dự án | BIG_ISSUE_OPTION), ...]
+    - Raw sheet: append_rows theo chunk POST_CHUNK_ROWS, giữ đúng thứ tự
+    - Sheet dự án: gom theo sheet → append_rows theo chunk; các sheet ghi song song
+      trên `workers` luồng (mỗi sheet 1 luồng nên thứ tự trong sheet giữ nguyên),
+      nhịp gọi do token bucket quyết định
+    - Account (số dư raw + D86): cộng dồn delta → 1 batch_update sau khi đọc lại cell;
+      số dư raw cộng cho MỌI dòng đã vào Raw, kể cả dòng ghi sheet dự án lỗi
+    → (list lỗi theo từng dòng (None = OK),
+       list delta Account chưa ghi được — xem ledger_commit,
+       list dòng đã vào Raw nhưng chưa vào sheet dự án [{'row', 'sheet', 'date', 'desc', 'amount', 'reason'}])
+    Dòng đã vào Raw thì lần sau B2 coi là đã hạch toán: phần chưa ghi được trả về để người dùng ghi tay.
+    """
+    n = len(items)
+    errors = [None] * n
+    worksheets = {}
+    ws_lock = threading.Lock()
+
+    def ws(name):
+        with ws_lock:
+            if name not in worksheets:
+                worksheets[name] = sheets_call(spreadsheet.worksheet, name)
+            return worksheets[name]
+
+    def fail(idxs, msg):
+        for i in idxs:
+            if errors[i] is None:
+                errors[i] = msg
+
+    deltas = [tx['credit'] if tx['direction'] == 'THU' else -tx['debit'] for tx, _ in items]
+    by_sheet = {}
+    for i, (_, project) in enumerate(items):
+        if project != BIG_ISSUE_OPTION:
+            by_sheet.setdefault(project, []).append(i)
+    n_chunks = lambda k: (k + POST_CHUNK_ROWS - 1) // POST_CHUNK_ROWS
+    total_steps = n_chunks(n) + len(by_sheet) + 1
+    done_steps = 0
+
+    def step(text):
+        nonlocal done_steps
+        done_steps += 1
+        if on_progress:
+            on_progress(done_steps, total_steps, text)
+
+    # 0. Index Account đọc 1 lần cho cả lượt — lỗi thì không ghi gì cả
+    try:
+        acc_ws, index = load_account_index(spreadsheet)
+    except Exception as e:
+        fail(range(n), f"Account: {e}")
+        return errors, [], []
+
+    # 1. Raw sheet — lô lỗi thì dừng, các dòng từ lô đó coi như chưa ghi (Raw luôn là prefix);
+    #    các lô đã append vẫn đi tiếp bước 2 + 3 vì lần sau B2 coi chúng là đã hạch toán
+    start = 0
+    in_raw = n
+    try:
+        raw_ws = ws(raw_sheet_name)
+        header = sheets_call(raw_ws.row_values, 1)
+        raw_rows = [build_raw_row(tx, header) for tx, _ in items]
+        for start in range(0, n, POST_CHUNK_ROWS):
+            end = min(start + POST_CHUNK_ROWS, n)
+            sheets_call(raw_ws.append_rows, raw_rows[start:end], value_input_option='USER_ENTERED',
+                        retry_status=SHEETS_APPEND_RETRY_STATUS)
+            step(f"{raw_sheet_name}: {end}/{n}")
+    except Exception as e:
+        in_raw = start
+        fail(range(start, n), f"{raw_sheet_name}: {e}")
+
+    # 2. Sheet dự án — chỉ ghi các dòng đã vào Raw, mỗi sheet 1 task;
+    #    lô lỗi → các dòng từ lô đó trả về (vị trí, lý do) để báo ghi tay
+    def post_project(project, idxs):
+        start = 0
+        try:
+            for start in range(0, len(idxs), POST_CHUNK_ROWS):
+                chunk = idxs[start:start + POST_CHUNK_ROWS]
+                rows = [project_row(items[i][0]['date'], items[i][0]['desc'], -deltas[i]) for i in chunk]
+                sheets_call(ws(project).append_rows, rows, value_input_option='USER_ENTERED',
+                            retry_status=SHEETS_APPEND_RETRY_STATUS)
+        except Exception as e:
+            fail(idxs[start:], f"{project}: {e}")
+            return [(i, str(e)) for i in idxs[start:]]
+        return []
+
+    unposted = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+        futures = {}
+        for project, idxs in by_sheet.items():
+            idxs = [i for i in idxs if i < in_raw]
+            if idxs:
+                futures[ex.submit(contextvars.copy_context().run, post_project, project, idxs)] = project
+            else:
+                step(project)
+        for fut in as_completed(futures):
+            project = futures[fut]
+            for i, reason in fut.result():
+                # đúng dòng lẽ ra đã ghi (project_row) để người dùng chép tay
+                date, desc, amount = project_row(items[i][0]['date'], items[i][0]['desc'], -deltas[i])
+                unposted.append({'row': i + 1, 'sheet': project, 'date': date, 'desc': desc,
+                                 'amount': amount, 'reason': reason})
+            step(project)
+    unposted.sort(key=lambda u: u['row'])
+
+    # 3. Account — cộng dồn delta số dư raw (mọi dòng đã vào Raw) + D86 vào ledger, ghi 1 lần.
+    #    Các dòng đã nằm trong Raw nên không thể "hạch toán lại": delta không ghi được thì
+    #    trả về cho người dùng
+    unapplied = []
+    if in_raw:
+        ledger = new_account_ledger(index)
+        for i in range(in_raw):
+            if items[i][1] == BIG_ISSUE_OPTION:
+                ledger_add(ledger, BIG_ISSUE_CELL, deltas[i])
+            ledger_add(ledger, raw_sheet_name, deltas[i])
+        _, unapplied = ledger_commit(ledger, acc_ws)
+    step('Account')
+    return errors, unapplied, unposted
+
+# ── PROJECT SUGGEST INDEX ──────────────────────────────────────
+SUGGEST_INDEX_PATH = os.environ.get('SUGGEST_INDEX_PATH', 'suggest_index.json')
+SUGGEST_INDEX_VERSION = 1
+SUGGEST_MIN_TOKEN = 4       # chỉ tính từ >= 4 ký tự
+SUGGEST_NAME_BONUS = 10     # tên sheet xuất hiện trong nội dung giao dịch
+SUGGEST_LAST_COL = 'ZZ'
+
+def suggest_tokens(text):
+    """Nội dung → token (upper, tách khoảng trắng, bỏ từ ngắn)"""
+    return [w for w in str(text or '').upper().split() if len(w) >= SUGGEST_MIN_TOKEN]
+
+def new_suggest_index(spreadsheet_id=None):
+    """Index gợi ý: {'sheets': {tên sheet: {'rows': số dòng đã index, 'tf': {token: count}}}}"""
+    return {'version': SUGGEST_INDEX_VERSION, 'spreadsheet': spreadsheet_id, 'sheets': {}}
+
+def load_suggest_index(spreadsheet_id, path=SUGGEST_INDEX_PATH):
+    """Đọc index đã lưu; khác spreadsheet / khác version / hỏng → index rỗng"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('version') == SUGGEST_INDEX_VERSION and index.get('spreadsheet') == spreadsheet_id:
+            return index
+    except (OSError, ValueError):
+        pass
+    return new_suggest_index(spreadsheet_id)
+
+def save_suggest_index(index, path=SUGGEST_INDEX_PATH):
+    """Ghi index (atomic qua file tạm), bỏ phần postings dựng lại được"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({k: v for k, v in index.items() if k != 'postings'}, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def refresh_suggest_index(spreadsheet, project_sheets, index):
+    """
+    Cập nhật tăng dần: 1 values_batch_get kéo các dòng nằm sau số dòng đã index
+    của mọi sheet dự án (sheet mới → đọc từ đầu) → số dòng mới được index
+    """
+    sheets = index['sheets']
+    for name in list(sheets):
+        if name not in project_sheets:
+            del sheets[name]
+    if not project_sheets:
+        return 0
+    ranges = ["'{}'!A{}:{}".format(name.replace("'", "''"),
+                                   sheets.get(name, {}).get('rows', 0) + 1, SUGGEST_LAST_COL)
+              for name in project_sheets]
+    resp = sheets_call(spreadsheet.values_batch_get, ranges)
+    added = 0
+    for name, vr in zip(project_sheets, resp.get('valueRanges', [])):
+        entry = sheets.setdefault(name, {'rows': 0, 'tf': {}})
+        values = vr.get('values', [])
+        tf = entry['tf']
+        for row in values:
+            for tok in suggest_tokens(' '.join(str(c) for c in row)):
+                tf[tok] = tf.get(tok, 0) + 1
+        entry['rows'] += len(values)
+        added += len(values)
+    index.pop('postings', None)
+    return added
+
+def suggest_postings(index):
+    """token → {sheet: trọng số TF-IDF}, dựng lại từ tf mỗi khi index đổi"""
+    if 'postings' not in index:
+        sheets = index['sheets']
+        df = {}
+        for entry in sheets.values():
+            for tok in entry['tf']:
+                df[tok] = df.get(tok, 0) + 1
+        postings = {}
+        for name, entry in sheets.items():
+            for tok, count in entry['tf'].items():
+                postings.setdefault(tok, {})[name] = (1 + math.log(count)) * math.log(1 + len(sheets) / df[tok])
+        index['postings'] = postings
+    return index['postings']
+
+def suggest_project_sheet(description, project_sheets, index):
+    """
+    Đề xuất sheet dự án dựa vào nội dung giao dịch — tra cục bộ trong index:
+    tổng trọng số TF-IDF các token + bonus khi tên sheet xuất hiện trong nội dung
+    → None nếu không có tín hiệu nào
+    """
+    if not description:
+        return None
+    postings = suggest_postings(index)
+    scores = {}
+    for tok in set(suggest_tokens(description)):
+        for name, w in postings.get(tok, {}).items():
+            scores[name] = scores.get(name, 0) + w
+
+    # Bonus: tên sheet xuất hiện trong description
+    desc_upper = description.upper()
+    for name in project_sheets:
+        if name.upper() in desc_upper:
+            scores[name] = scores.get(name, 0) + SUGGEST_NAME_BONUS
+
+    return max((n for n in scores if n in project_sheets), key=scores.get, default=None)
+
 # ── PHASE 2 UI ───────────────────────────────────────────────
+def load_tx_table(handle):
+    """Bảng giao dịch của 1 nhóm: đọc đĩa 1 lần rồi giữ trong session theo handle
+    (chỉ giữ bảng của nhóm đang duyệt) — rerun / bấm nút không đọc lại; None nếu đã bị xoá"""
+    cached = st.session_state.get('p2_tx_table')
+    if cached and cached['handle'] == handle:
+        return cached['table']
+    path = result_path(handle)
+    if path is None:
+        return None
+    with timer('result_store.load_tx'):
+        table = pd.read_pickle(path)
+    st.session_state.p2_tx_table = {'handle': handle, 'table': table}
+    return table
+
 def render_phase2():
     st.divider()
     st.header("📋 Phase 2 — Duyệt lệnh & Hạch toán")
@@ -669,7 +898,7 @@ def render_phase2():
     # Load credentials
     creds_json = None
     try:
-        creds_json = dict(st.secrets["gcp_service_account"])
+        creds_json = {} if GSHEET_BACKEND else dict(st.secrets["gcp_service_account"])
     except:
         creds_file = st.file_uploader(
             "🔑 Upload file credentials JSON (Google Service Account)",
@@ -693,6 +922,18 @@ def render_phase2():
     
     spreadsheet = st.session_state.spreadsheet
     project_sheets = st.session_state.project_sheets
+
+    # Index gợi ý sheet dự án: đọc từ đĩa, cập nhật tăng dần 1 lần / session
+    if 'suggest_index' not in st.session_state:
+        index = load_suggest_index(spreadsheet.id)
+        with st.spinner("🧠 Đang cập nhật index gợi ý sheet dự án..."):
+            try:
+                if refresh_suggest_index(spreadsheet, project_sheets, index):
+                    save_suggest_index(index)
+            except Exception as e:
+                st.warning(f"⚠️ Không cập nhật được index gợi ý: {e}")
+        st.session_state.suggest_index = index
+    suggest_index = st.session_state.suggest_index
     
     st.success(f"✅ Đã kết nối: **{spreadsheet.title}**")
 
@@ -713,63 +954,15 @@ def render_phase2():
     )
 
     res = ok_results[selected_key]
-    res['data'].seek(0)
-
-    wb = openpyxl.load_workbook(res['data'], data_only=True)
-    ws_merged = wb.active
-    rows = [list(r) for r in ws_merged.iter_rows(values_only=True)]
 
     bank_id = selected_key.split('_')[0]
-    h_idx = find_header_row(rows, bank_id)
-    if h_idx < 0:
-        st.error("Không tìm thấy header row trong file merged")
+    # Giao dịch đã dựng sẵn lúc merge (Phase 1), spill ra đĩa — không đọc lại file xuất
+    tx_table = load_tx_table(res['tx_handle'])
+    if tx_table is None:
+        st.warning("⚠️ Kết quả merge đã hết hạn và bị xoá khỏi đĩa. Vui lòng chạy lại Phase 1!")
         return
 
-    headers = [str(c or '').replace('\n',' ').strip() for c in rows[h_idx]]
-
-    # Build TOÀN BỘ transactions
-    all_transactions = []
-    for row in rows[h_idx+1:]:
-        flat = ''.join([str(c or '') for c in row]).strip()
-        if not flat: continue
-
-        d = None
-        date_str = ''
-        for ci in range(min(5, len(row))):
-            d = parse_date(row[ci])
-            if d:
-                date_str = str(row[ci]).split('\n')[0].strip()
-                break
-        if not d: continue
-
-        tx = {'date': date_str, 'desc': '', 'debit': 0, 'credit': 0,
-              'balance': 0, 'ref': '', 'counter_name': '', 'counter_acct': ''}
-
-        for i, h in enumerate(headers):
-            if i >= len(row): continue
-            val = row[i]
-            h_l = h.lower()
-            if any(k in h_l for k in ['nội dung','diễn giải','mô tả','description','transactions in detail']):
-                tx['desc'] = str(val or '').strip()
-            elif any(k in h_l for k in ['rút ra','ghi nợ','nợ/ debit','no/debit','debit']):
-                tx['debit'] = parse_amount(val)
-            elif any(k in h_l for k in ['gửi vào','ghi có','có / credit','co/credit','credit']):
-                tx['credit'] = parse_amount(val)
-            elif any(k in h_l for k in ['số dư','balance']):
-                tx['balance'] = parse_amount(val)
-            elif any(k in h_l for k in ['số gd','so but toan','transaction number','số giao dịch','số tham chiếu','reference']):
-                tx['ref'] = str(val or '').strip()
-            elif any(k in h_l for k in ['tên tk','corresponsive name','tên tài khoản đối']):
-                tx['counter_name'] = str(val or '').strip()
-            elif any(k in h_l for k in ['tk đối','corresponsive account','số tài khoản đối']):
-                tx['counter_acct'] = str(val or '').strip()
-
-        if tx['debit'] == 0 and tx['credit'] == 0: continue
-        tx['direction'] = 'THU' if tx['credit'] > 0 else 'CHI'
-        tx['amount'] = tx['credit'] if tx['credit'] > 0 else tx['debit']
-        all_transactions.append(tx)
-
-    if not all_transactions:
+    if tx_table.empty:
         st.warning("Không có giao dịch nào trong file này")
         return
 
@@ -786,26 +979,23 @@ def render_phase2():
     with st.spinner("🔍 B2: Đang tìm giao dịch cuối trong Raw sheet..."):
         last_ref = get_last_ref_from_raw(spreadsheet, raw_sheet_gsheet)
 
+    # Điểm cắt = lần xuất hiện đầu tiên của ref cuối (so cả cột 1 lượt)
     cutoff_idx = -1
     cutoff_balance = 0
     if last_ref:
-        for i, tx in enumerate(all_transactions):
-            if tx['ref'] == last_ref:
-                cutoff_idx = i
-                cutoff_balance = tx['balance']
-                break
+        hits = tx_table['ref'].eq(last_ref).to_numpy().nonzero()[0]
+        if len(hits):
+            cutoff_idx = int(hits[0])
+            cutoff_balance = int(tx_table['balance'].iat[cutoff_idx])
 
     if last_ref and cutoff_idx >= 0:
-        st.info(f"🔗 Ref cuối trong Raw sheet: `{last_ref}` → vị trí #{cutoff_idx + 1}/{len(all_transactions)}")
-        new_transactions = all_transactions[cutoff_idx + 1:]
+        st.info(f"🔗 Ref cuối trong Raw sheet: `{last_ref}` → vị trí #{cutoff_idx + 1}/{len(tx_table)}")
     elif last_ref and cutoff_idx < 0:
         st.warning(f"⚠️ Ref cuối `{last_ref}` không tìm thấy trong file merged. Hiển thị tất cả.")
-        new_transactions = all_transactions
-        cutoff_balance = 0
     else:
         st.info("📭 Raw sheet trống — hiển thị tất cả giao dịch")
-        new_transactions = all_transactions
-        cutoff_balance = 0
+    # Chỉ dựng dict cho phần giao dịch mới
+    new_transactions = tx_table.iloc[cutoff_idx + 1:].to_dict('records')
 
     # ═══════════════════════════════════════════════
     # B3: DOUBLE CHECK SỐ DƯ
@@ -837,6 +1027,18 @@ def render_phase2():
         else:
             st.warning(f"⚠️ Không tìm thấy số dư cho `{raw_sheet_gsheet}` trong sheet Account")
 
+    # Đối soát chuỗi số dư toàn bộ sao kê đã merge — tìm ngày thiếu, dedup nhầm, số tiền đọc sai
+    breaks = check_balance_chain(tx_table)
+    if breaks is not None:
+        if breaks.empty:
+            st.success(f"🔗 Chuỗi số dư liền mạch trên {len(tx_table):,} giao dịch")
+        else:
+            new_breaks = int((breaks['pos'] > cutoff_idx + 1).sum())
+            st.warning(f"🔗 Chuỗi số dư gãy tại **{len(breaks)}** vị trí "
+                       f"({new_breaks} trong phần giao dịch mới)")
+            with st.expander("Chi tiết điểm gãy"):
+                st.dataframe(breaks, hide_index=True, use_container_width=True)
+
     st.divider()
 
     # ═══════════════════════════════════════════════
@@ -852,6 +1054,16 @@ def render_phase2():
 
     dropdown_options = [BIG_ISSUE_OPTION] + project_sheets
 
+    # Sheet cho từng dòng: 1 list / nhóm trong session (mặc định = gợi ý từ index),
+    # lưới data_editor chỉ là view của list này
+    sel_key = f"p2_sheet_{selected_key}"
+    sel = st.session_state.get(sel_key)
+    if not sel or sel['cutoff'] != cutoff_idx or len(sel['sheets']) != len(transactions):
+        sel = {'cutoff': cutoff_idx, 'version': 0,
+               'sheets': [suggest_project_sheet(tx['desc'], project_sheets, suggest_index) or BIG_ISSUE_OPTION
+                          for tx in transactions]}
+        st.session_state[sel_key] = sel
+
     col_bulk1, col_bulk2 = st.columns([3, 1])
     with col_bulk1:
         bulk_sheet = st.selectbox(
@@ -862,47 +1074,29 @@ def render_phase2():
     with col_bulk2:
         if st.button("Áp dụng", use_container_width=True, key="apply_bulk"):
             if bulk_sheet != "-- Không áp dụng --":
-                for i in range(len(transactions)):
-                    st.session_state[f"p2_sheet_{selected_key}_{i}"] = bulk_sheet
-                st.rerun()
-
-    st.divider()
-
-    for i, tx in enumerate(transactions):
-        color = "🟢" if tx['direction'] == 'THU' else "🔴"
-        amount_fmt = f"{tx['amount']:,.0f}"
-        sign = "+" if tx['direction'] == 'THU' else "-"
-
-        c1, c2, c3, c4 = st.columns([1.2, 3.5, 2, 2.5])
-
-        with c1:
-            st.markdown(f"**{tx['date']}**")
-            st.caption(f"{color} {tx['direction']}")
-
-        with c2:
-            desc_short = tx['desc'][:80] + ('...' if len(tx['desc']) > 80 else '')
-            st.markdown(f"{desc_short}")
-            if tx['counter_name']:
-                st.caption(f"👤 {tx['counter_name']}")
-
-        with c3:
-            st.markdown(f"**{sign}{amount_fmt}**")
-
-        with c4:
-            default_key = f"p2_sheet_{selected_key}_{i}"
-            default_idx = 0
-            if default_key in st.session_state and st.session_state[default_key] in dropdown_options:
-                default_idx = dropdown_options.index(st.session_state[default_key])
-
-            st.selectbox(
-                "Sheet",
-                dropdown_options,
-                index=default_idx,
-                key=default_key,
-                label_visibility="collapsed"
-            )
-
-        st.markdown("<hr style='margin:2px 0; border:none; border-top:1px solid #333'>", unsafe_allow_html=True)
+                sel['sheets'] = [bulk_sheet] * len(transactions)
+                sel['version'] += 1     # key lưới mới → bỏ các chỉnh sửa cũ của data_editor
+
+    grid = pd.DataFrame({
+        'Ngày': [tx['date'] for tx in transactions],
+        'Loại': [("🟢 " if tx['direction'] == 'THU' else "🔴 ") + tx['direction'] for tx in transactions],
+        'Nội dung': [tx['desc'] for tx in transactions],
+        'Đối tác': [tx['counter_name'] for tx in transactions],
+        'Số tiền': [f"{'+' if tx['direction'] == 'THU' else '-'}{tx['amount']:,.0f}" for tx in transactions],
+        'Sheet': sel['sheets'],
+    })
+    edited = st.data_editor(
+        grid,
+        key=f"p2_grid_{selected_key}_{sel['version']}",
+        hide_index=True,
+        use_container_width=True,
+        disabled=[c for c in grid.columns if c != 'Sheet'],
+        column_config={
+            'Nội dung': st.column_config.TextColumn(width='large'),
+            'Sheet': st.column_config.SelectboxColumn(options=dropdown_options, required=True),
+        },
+    )
+    sel['sheets'] = edited['Sheet'].tolist()
 
     st.divider()
 
@@ -916,41 +1110,27 @@ def render_phase2():
 
     if st.button("✅ Duyệt & Hạch toán TẤT CẢ", type="primary", use_container_width=True):
         progress_bar = st.progress(0, text="Đang hạch toán...")
-        success_count = 0
-        error_list = []
-
-        for i, tx in enumerate(transactions):
-            try:
-                sheet_key = f"p2_sheet_{selected_key}_{i}"
-                selected_project = st.session_state.get(sheet_key, dropdown_options[0])
+        items = list(zip(transactions, sel['sheets']))
 
-                raw_row = build_raw_row(tx, raw_sheet_gsheet, spreadsheet)
-                append_to_raw_sheet(spreadsheet, raw_sheet_gsheet, raw_row)
+        def on_progress(done, total, text):
+            progress_bar.progress(done / total, text=f"Đang hạch toán... {text}")
 
-                delta = tx['credit'] if tx['direction'] == 'THU' else -tx['debit']
+        if st.session_state.get('diagnostics'):
+            metrics_start()
+        with timer('post_transactions'):
+            errors, unapplied, unposted = post_transactions(spreadsheet, raw_sheet_gsheet, items, on_progress)
+        add_count('post.rows', len(items))
+        add_count('post.errors', sum(1 for e in errors if e))
+        success_count = sum(1 for e in errors if e is None)
+        error_list = [f"Dòng {i+1}: {e}" for i, e in enumerate(errors) if e]
 
-                if selected_project == BIG_ISSUE_OPTION:
-                    update_big_issue(spreadsheet, delta)
-                else:
-                    append_to_project_sheet(spreadsheet, selected_project,
-                                           tx['date'], tx['desc'], -delta)
-
-                cell_addr, _ = get_account_cell(spreadsheet, raw_sheet_gsheet)
-                if cell_addr:
-                    update_account_balance(spreadsheet, cell_addr, delta)
-
-                success_count += 1
-
-            except Exception as e:
-                error_list.append(f"Dòng {i+1}: {str(e)}")
-
-            progress_bar.progress((i + 1) / len(transactions),
-                                  text=f"Đang hạch toán... {i+1}/{len(transactions)}")
+        progress_bar.progress(1.0, text="Hoàn tất!")
 
-            import time
-            time.sleep(0.3)
+        # Backend giả: in số lời gọi API theo loại
+        if hasattr(spreadsheet, 'stats'):
+            st.caption("📊 API calls: " + ", ".join(f"{k}={v}" for k, v in spreadsheet.stats.most_common()))
 
-        progress_bar.progress(1.0, text="Hoàn tất!")
+        render_diagnostics(metrics_stop(), 'phase2')
 
         if success_count > 0:
             st.success(f"✅ Đã hạch toán thành công **{success_count}/{len(transactions)}** giao dịch vào **{raw_sheet_gsheet}**")
@@ -958,6 +1138,19 @@ def render_phase2():
             with st.expander(f"⚠️ {len(error_list)} lỗi", expanded=True):
                 for e in error_list:
                     st.error(e)
+        if unposted:
+            st.error("❌ Giao dịch đã vào Raw nhưng **chưa vào sheet dự án** — "
+                     "KHÔNG hạch toán lại, hãy thêm tay các dòng dưới đây:")
+            st.dataframe(pd.DataFrame(unposted).rename(columns={
+                'row': 'Dòng', 'sheet': 'Sheet dự án', 'date': 'Ngày', 'desc': 'Nội dung',
+                'amount': 'Số tiền', 'reason': 'Lý do'}),
+                hide_index=True, use_container_width=True)
+        if unapplied:
+            st.error("❌ Giao dịch đã vào Raw nhưng **chưa cộng vào sheet Account** — "
+                     "KHÔNG hạch toán lại, hãy cộng tay các delta dưới đây:")
+            st.dataframe(pd.DataFrame(unapplied).rename(columns={
+                'cell': 'Cell', 'key': 'Số dư', 'delta': 'Delta cần cộng', 'reason': 'Lý do'}),
+                hide_index=True, use_container_width=True)
 
 # Thêm tab Phase 2 vào app
 st.divider()
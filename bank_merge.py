@@ -0,0 +1,1313 @@
+"""
+Engine merge sao kê ngân hàng (Phase 1) — thư viện thuần, không import Streamlit / Google:
+nhận dạng bank + số TK, đọc stream xlsx/xls/csv, dedup, sort, xuất file.
+pandas / numpy / openpyxl / xlrd chỉ import khi thực sự cần.
+
+CLI (vd. merge hằng đêm qua cron):
+    python bank_merge.py <thư mục sao kê> -o <thư mục xuất> [-f xlsx|csv|parquet] [-w N]
+"""
+import argparse
+import sys
+import codecs
+import csv
+from io import BytesIO, TextIOWrapper
+from datetime import datetime
+from itertools import islice, chain
+from array import array
+import re
+import hashlib
+import json
+import sqlite3
+import os
+import contextvars
+import threading
+import time
+import types
+import multiprocessing as mp
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# ── INSTRUMENTATION ────────────────────────────────────────────
+# Bộ đo theo lượt chạy (ContextVar, không phải biến module): mỗi session / thread có
+# bộ đo riêng nên các user chạy song song không ghi đè hay tắt đo của nhau.
+# None = tắt (hook trả về ngay / nullcontext dùng chung),
+# dict = đang đo {'timers': {tên: [giây, số lần]}, 'counts': {tên: n}}
+# Thread pool muốn đo chung với lượt gọi: submit qua contextvars.copy_context().run
+_metrics = contextvars.ContextVar('bank_merge_metrics', default=None)
+_NO_TIMER = nullcontext()
+
+def metrics_start():
+    """Bật đo cho lượt chạy hiện tại, bỏ số liệu cũ"""
+    _metrics.set({'started': datetime.now().isoformat(timespec='seconds'),
+                  'timers': {}, 'counts': {}, 'lock': threading.Lock()})
+
+def metrics_stop():
+    """Tắt đo → số liệu đã gom (None nếu chưa bật)"""
+    m = _metrics.get()
+    _metrics.set(None)
+    return m
+
+def metrics_on():
+    return _metrics.get() is not None
+
+def add_time(name, seconds, calls=1):
+    m = _metrics.get()
+    if m is None: return
+    with m['lock']:
+        t = m['timers'].setdefault(name, [0.0, 0])
+        t[0] += seconds
+        t[1] += calls
+
+def add_count(name, n=1):
+    m = _metrics.get()
+    if m is None: return
+    with m['lock']:
+        m['counts'][name] = m['counts'].get(name, 0) + n
+
+def metrics_merge(other):
+    """Cộng số liệu từ process con vào bộ đo hiện tại"""
+    for name, (seconds, calls) in other['timers'].items():
+        add_time(name, seconds, calls)
+    for name, n in other['counts'].items():
+        add_count(name, n)
+
+@contextmanager
+def _timed(name):
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - t)
+
+def timer(name):
+    """with timer('stage'): ... — tắt đo thì là nullcontext dùng chung"""
+    return _NO_TIMER if _metrics.get() is None else _timed(name)
+
+def timed_fn(name, fn):
+    """Bọc fn để cộng dồn thời gian mỗi lần gọi — tắt đo thì trả nguyên fn (vòng lặp nóng không đổi)"""
+    if _metrics.get() is None:
+        return fn
+    perf = time.perf_counter
+    def wrapped(*args):
+        t = perf()
+        try:
+            return fn(*args)
+        finally:
+            add_time(name, perf() - t)
+    return wrapped
+
+def timed_iter(name, it):
+    """Như timed_fn cho iterator: đo thời gian lấy từng phần tử (decode file)"""
+    if _metrics.get() is None:
+        return it
+    return _timed_iter(name, iter(it))
+
+def _timed_iter(name, it):
+    perf = time.perf_counter
+    total, n = 0.0, 0
+    try:
+        while True:
+            t = perf()
+            try:
+                item = next(it)
+            except StopIteration:
+                break
+            total += perf() - t
+            n += 1
+            yield item
+    finally:
+        add_time(name, total, n)
+
+def metrics_report(m):
+    """Số liệu đo → dict JSON được (run report)"""
+    return {
+        'started': m['started'],
+        'timers': {k: {'seconds': round(s, 6), 'calls': c}
+                   for k, (s, c) in sorted(m['timers'].items(), key=lambda x: -x[1][0])},
+        'counts': dict(sorted(m['counts'].items())),
+    }
+
+# ── BANK PROFILES ──────────────────────────────────────────────
+# Mỗi bank khai báo 1 lần; thêm bank (BIDV, Sacombank...) = thêm 1 entry:
+#   signature: list phương án, mỗi phương án = list chuỗi phải có ĐỦ trong 15 dòng đầu
+#              (phân biệt hoa thường; tiền tố '(?i)' = không phân biệt)
+#              — bank đầu tiên khớp theo thứ tự registry thắng
+#   account:   luật lấy số TK (xem ACCOUNT_RULES) + tham số
+#   header:    keyword phải có đủ trong dòng header
+#   columns:   (tuỳ chọn) keyword vai trò cột riêng, mặc định REF_KWS / DATE_KWS /
+#              DEDUP_AMOUNT_KWS / AMOUNT_KWS / TX_ROLE_KWS
+BANK_PROFILES = [
+    {'id': 'ACB',
+     'signature': [['BẢNG SAO KÊ GIAO DỊCH']],
+     'account': {'rule': 'regex', 'patterns': [r'[Ss]ố tài khoản.*?:\s*(\d+)', r'[Tt]ài khoản số:\s*(\d+)']},
+     'header': ['ngày hiệu lực', 'số gd']},
+    {'id': 'VCB',
+     'signature': [['SAO KÊ TÀI KHOẢN'], ['STATEMENT OF ACCOUNT']],
+     'account': {'rule': 'label_row', 'labels': ['tài khoản', 'account number'], 'rows': 10},
+     'header': ['debit', 'credit']},
+    {'id': 'TCB',
+     'signature': [['(?i)so but toan', '(?i)ngay giao dich']],
+     'account': {'rule': 'cell', 'row': 1, 'col': 1},
+     'header': ['so but toan', 'no/debit']},
+    {'id': 'VTB',
+     'signature': [['(?i)VIETINBANK'], ['(?i)efast'], ['LỊCH SỬ GIAO DỊCH']],
+     'account': {'rule': 'next_cell', 'labels': ['account no', 'số tài khoản']},
+     'header': ['accounting date', 'debit']},
+    {'id': 'MB',
+     'signature': [['(?i)MB BANK'], ['(?i)MILITARY']],
+     'account': {'rule': 'next_cell', 'labels': ['account no', 'số tài khoản']},
+     'header': ['ngày giao dịch', 'số tiền']},
+]
+BANKS = {p['id']: p for p in BANK_PROFILES}
+
+def _trie_regex(words):
+    """Regex dạng trie cho list chuỗi literal: nhánh tách theo ký tự chung,
+    chi phí mỗi vị trí không tăng tuyến tính theo số chuỗi; khớp dài nhất trước"""
+    root = {}
+    for w in words:
+        node = root
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[''] = {}
+
+    def emit(node):
+        alts = [re.escape(ch) + emit(sub) for ch, sub in sorted(node.items()) if ch]
+        if not alts: return ''
+        body = alts[0] if len(alts) == 1 else '(?:' + '|'.join(alts) + ')'
+        return '(?:' + body + ')?' if '' in node else body
+    return emit(root)
+
+def _overlap_offsets(w, words):
+    """Các vị trí k bên trong w mà 1 chuỗi khác có thể bắt đầu (chứa trong w
+    hoặc đuôi của w là đầu của nó) — finditer không chồng lấn sẽ bỏ sót"""
+    return [k for k in range(1, len(w))
+            if any(v.startswith(w[k:]) or w[k:].startswith(v) for v in words)]
+
+def compile_signatures(profiles):
+    """Gộp signature mọi bank thành 1 regex trie trên text lowercase → quét 15 dòng
+    đầu 1 lượt duy nhất; chuỗi phân biệt hoa thường chỉ kiểm lại khi bản lowercase
+    của nó đã xuất hiện. Chi phí gần như không đổi khi thêm bank.
+    """
+    needles = {}
+    for p in profiles:
+        for option in p['signature']:
+            for n in option:
+                needles.setdefault(n, (n[4:], True) if n.startswith('(?i)') else (n, False))
+    words = sorted({text.lower() for text, _ in needles.values()})
+    by_word = {w: [] for w in words}
+    for n, (text, icase) in needles.items():
+        by_word[text.lower()].append((n, None if icase else text))
+    # needle → các phương án (thứ tự ưu tiên, bank, set chuỗi cần có) chứa nó
+    options = {n: [] for n in needles}
+    for prio, p in enumerate(profiles):
+        for option in p['signature']:
+            for n in set(option):
+                options[n].append((prio, p['id'], frozenset(option)))
+    return {
+        'regex': re.compile(_trie_regex(words)) if words else None,
+        # chuỗi khớp tại 1 vị trí ⇒ mọi chuỗi là tiền tố của nó cũng khớp tại đó
+        'prefixes': {w: [v for v in words if w.startswith(v)] for w in words},
+        'overlaps': {w: _overlap_offsets(w, words) for w in words},
+        # chuỗi lowercase → [(needle, text cần kiểm lại hoa thường hoặc None)]
+        'needles': by_word,
+        'options': options,
+    }
+
+SIGNATURES = compile_signatures(BANK_PROFILES)
+
+def detect_bank(rows):
+    flat = ' '.join([str(c) for r in rows[:15] for c in r if c])
+    sig = SIGNATURES
+    if sig['regex'] is None:
+        return None
+    low = flat.lower()
+    seen = set()
+    for m in sig['regex'].finditer(low):
+        todo = [(m.group(), m.start())]
+        while todo:
+            w, pos = todo.pop()
+            seen.update(sig['prefixes'][w])
+            # chuỗi khác bắt đầu bên trong lần khớp này (hiếm) → khớp lại tại đó
+            for k in sig['overlaps'][w]:
+                m2 = sig['regex'].match(low, pos + k)
+                if m2: todo.append((m2.group(), pos + k))
+    found = {n for w in seen for n, exact in sig['needles'][w] if exact is None or exact in flat}
+    matched = [(prio, bank_id) for n in found for prio, bank_id, option in sig['options'][n] if option <= found]
+    return min(matched)[1] if matched else None
+
+# ── luật lấy số tài khoản ──
+def _account_regex(rows, patterns):
+    """Regex trên từng dòng (nối cell) — group 1 là số TK"""
+    for line in [' '.join([str(c) for c in r if c]) for r in rows[:15]]:
+        for pat in patterns:
+            m = re.search(pat, line)
+            if m: return m.group(1)
+
+def _account_label_row(rows, labels, rows_limit=15):
+    """Cell chứa nhãn → số ≥ 8 chữ số ở các cell sau trong dòng, hoặc ngay trong cell nhãn"""
+    for r in rows[:rows_limit]:
+        for i, cell in enumerate(r):
+            if cell and any(lb in str(cell).lower() for lb in labels):
+                for j in range(i+1, len(r)):
+                    v = str(r[j] or '').strip()
+                    if re.match(r'^\d{8,}$', v): return v
+                m = re.search(r'\d{8,}', str(cell))
+                if m: return m.group(0)
+
+def _account_next_cell(rows, labels):
+    """Cell chứa nhãn → số ≥ 8 chữ số trong cell kế bên"""
+    for r in rows[:15]:
+        for i, cell in enumerate(r):
+            if cell and any(lb in str(cell).lower() for lb in labels):
+                if i+1 < len(r):
+                    m = re.search(r'\d{8,}', str(r[i+1] or ''))
+                    if m: return m.group(0)
+
+def _account_cell(rows, row, col):
+    """Số TK nằm cố định ở 1 cell"""
+    if len(rows) > row and len(rows[row]) > col:
+        return str(rows[row][col] or '').strip()
+
+ACCOUNT_RULES = {
+    'regex':     lambda rows, a: _account_regex(rows, a['patterns']),
+    'label_row': lambda rows, a: _account_label_row(rows, a['labels'], a.get('rows', 15)),
+    'next_cell': lambda rows, a: _account_next_cell(rows, a['labels']),
+    'cell':      lambda rows, a: _account_cell(rows, a['row'], a['col']),
+}
+
+def get_account_no(rows, bank_id):
+    profile = BANKS.get(bank_id)
+    if profile:
+        acct = ACCOUNT_RULES[profile['account']['rule']](rows, profile['account'])
+        if acct is not None:
+            return acct
+    return 'unknown'
+
+def find_header_row(rows, bank_id):
+    keywords = BANKS[bank_id]['header'] if bank_id in BANKS else []
+    for i, row in enumerate(rows):
+        # Normalize: replace newlines + tabs → space trước khi so sánh
+        flat = ' '.join([str(c or '').replace('\n',' ').replace('\t',' ').lower() for c in row])
+        if all(kw in flat for kw in keywords):
+            return i
+    return -1
+
+def parse_amount(val):
+    """Normalize số: xóa dấu . và , phân cách nghìn → số nguyên"""
+    if val is None or str(val).strip() == '': return 0
+    s = str(val).strip()
+    # Xóa chữ VND và ký tự không phải số ở cuối (VD: "21,991,508 VND")
+    s = re.sub(r'[A-Za-z\s]+$', '', s).strip()
+    if not s: return 0
+    # Xóa tất cả dấu chấm và phẩy (VN dùng . hoặc , để phân cách nghìn)
+    s = re.sub(r'[,\.]', '', s)
+    try:
+        return int(float(s))
+    except:
+        return 0
+
+DATE_PATTERNS = [
+    ('dmy',      re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4})')),   # dd/mm/yyyy [HH:MM]
+    ('ymd',      re.compile(r'^(\d{4})-(\d{2})-(\d{2})')),       # yyyy-mm-dd [HH:MM:SS]
+    ('dmy_dash', re.compile(r'^(\d{1,2})-(\d{1,2})-(\d{4})')),   # dd-mm-yyyy [HH:MM:SS]
+]
+DATE_REGEX = dict(DATE_PATTERNS)
+DATE_SCAN_COLS = 5        # ngày nằm trong 5 cột đầu
+DATE_SAMPLE_ROWS = 30     # số data row dùng để chốt cột + format ngày
+DATE_MEMO_MAX = 10000
+
+def _match_date(fmt, m):
+    g = m.groups()
+    if fmt == 'ymd':
+        return datetime(int(g[0]), int(g[1]), int(g[2]))
+    return datetime(int(g[2]), int(g[1]), int(g[0]))
+
+def parse_date_fmt(val):
+    """Parse date từ nhiều format → (datetime, format) hoặc (None, None)"""
+    if not val: return None, None
+    # Nếu là datetime object (openpyxl trả về datetime)
+    if hasattr(val, 'year'): return val, 'datetime'
+    s = str(val).strip().split('\n')[0]  # VCB merged cell
+    for fmt, p in DATE_PATTERNS:
+        m = p.match(s)
+        if m:
+            try:
+                return _match_date(fmt, m), fmt
+            except ValueError:
+                continue
+    return None, None
+
+def parse_date(val):
+    """Parse date từ nhiều format"""
+    return parse_date_fmt(val)[0]
+
+def find_row_date(row):
+    """Đường chung: ngày hợp lệ đầu tiên trong các cột đầu → (datetime, cột)"""
+    for ci in range(min(DATE_SCAN_COLS, len(row))):
+        d = parse_date(row[ci])
+        if d: return d, ci
+    return None, -1
+
+def detect_date_format(data_rows):
+    """Chốt cột ngày + format 1 lần từ mẫu data rows → (cột, format)"""
+    votes = {}
+    for row in data_rows:
+        for ci in range(min(DATE_SCAN_COLS, len(row))):
+            d, fmt = parse_date_fmt(row[ci])
+            if d:
+                votes[(ci, fmt)] = votes.get((ci, fmt), 0) + 1
+                break
+    if not votes:
+        return None, None
+    return max(votes, key=votes.get)
+
+def parse_date_locked(val, date_fmt):
+    """Parse 1 giá trị theo format đã chốt → datetime, None nếu trượt"""
+    if date_fmt == 'datetime':
+        return val if hasattr(val, 'year') else None
+    if not val or hasattr(val, 'year'):
+        return None
+    m = DATE_REGEX[date_fmt].match(str(val).strip().split('\n')[0])
+    if not m:
+        return None
+    try:
+        return _match_date(date_fmt, m)
+    except ValueError:
+        return None
+
+def make_date_reader(date_col, date_fmt):
+    """Parser ngày cho 1 file: chỉ đọc cột đã chốt bằng 1 pattern + memo,
+    trượt (miss) mới quay về find_row_date. Trả về hàm row → (datetime, cột)."""
+    if date_col is None:
+        return find_row_date
+    memo = {}
+
+    def read_date(row):
+        if date_col < len(row):
+            val = row[date_col]
+            cacheable = isinstance(val, str)
+            d = memo.get(val) if cacheable else None
+            if d is None:
+                d = parse_date_locked(val, date_fmt)
+                if d is not None and cacheable:
+                    if len(memo) >= DATE_MEMO_MAX:
+                        memo.clear()
+                    memo[val] = d
+            if d is not None:
+                return d, date_col
+        return find_row_date(row)
+    return read_date
+
+def get_dedup_key(row, plan, bank_id, account_no):
+    """Tạo key để dedup (dùng column plan đã compile sẵn)"""
+    ref = _first_value(row, plan['ref_groups'])
+
+    date_str = _first_value(row, plan['date_groups'])
+    if not date_str and len(row) > 0:
+        date_str = str(row[0] or '').strip()
+
+    amounts = []
+    n = len(row)
+    for i in plan['dedup_amount_cols']:
+        if i < n:
+            v = parse_amount(row[i])
+            if v > 0: amounts.append(str(v))
+
+    if ref:
+        return f"{bank_id}_{account_no}_{ref}"
+    else:
+        return f"{bank_id}_{account_no}_{date_str}_{'|'.join(amounts)}"
+
+def normalize_row(row, plan):
+    """Normalize số trong row"""
+    mask = plan['amount_mask']
+    n_mask = len(mask)
+    return [parse_amount(cell) if i < n_mask and mask[i]
+            else (str(cell) if cell is not None else '')
+            for i, cell in enumerate(row)]
+
+def dedup_key_tuple(row, clean_row, plan):
+    """Key dedup như get_dedup_key, bỏ prefix bank_account (giống nhau trong
+    cả nhóm): ('R', ref) hoặc ('D', ngày, 'số tiền|...').
+    Ref/ngày lấy từ cell gốc (ô số 0 = rỗng như str(cell or '')),
+    số tiền lấy từ row đã normalize."""
+    ref = _first_value(row, plan['ref_groups'])
+    if ref:
+        return ('R', ref)
+    date_str = _first_value(row, plan['date_groups'])
+    if not date_str and len(row) > 0:
+        date_str = str(row[0] or '').strip()
+    n = len(clean_row)
+    amounts = '|'.join([str(clean_row[i]) for i in plan['dedup_amount_cols']
+                        if i < n and clean_row[i] > 0])
+    return ('D', date_str, amounts)
+
+# ── DEDUP INDEX ────────────────────────────────────────────────
+# Bảng băm mở trên array: mỗi slot = digest 64-bit + vị trí row đã giữ (4 byte)
+# thay cho set các key f-string. Trùng digest → so khớp key thật của row đã giữ.
+DEDUP_MIN_SLOTS = 1 << 10
+_DIGEST_MASK = (1 << 64) - 1
+
+def new_dedup_index(slots=DEDUP_MIN_SLOTS):
+    return {'digests': array('Q', bytes(8 * slots)), 'pos': array('i', bytes(4 * slots)),
+            'mask': slots - 1, 'count': 0, 'collisions': 0}
+
+def _dedup_index_grow(index):
+    old_digests, old_pos = index['digests'], index['pos']
+    slots = len(old_digests) * 2
+    digests, pos, mask = array('Q', bytes(8 * slots)), array('i', bytes(4 * slots)), slots - 1
+    for d, p in zip(old_digests, old_pos):
+        if d:
+            i = d & mask
+            while digests[i]:
+                i = (i + 1) & mask
+            digests[i] = d
+            pos[i] = p
+    index.update(digests=digests, pos=pos, mask=mask)
+
+def dedup_index_add(index, key, pos, key_at):
+    """Thêm key của row ở vị trí pos; False nếu key đã có (row trùng).
+    key_at(p) → key của row đã giữ ở vị trí p, dùng khi trùng digest."""
+    digest = (hash(key) & _DIGEST_MASK) or 1   # 0 = slot trống
+    digests, mask = index['digests'], index['mask']
+    i = digest & mask
+    while True:
+        d = digests[i]
+        if not d:
+            break
+        if d == digest:
+            if key_at(index['pos'][i]) == key:
+                return False
+            index['collisions'] += 1
+        i = (i + 1) & mask
+    digests[i] = digest
+    index['pos'][i] = pos
+    index['count'] += 1
+    if index['count'] * 3 > len(digests) * 2:
+        _dedup_index_grow(index)
+    return True
+
+def dedup_index_bytes(index):
+    """Bộ nhớ của index (byte)"""
+    return len(index['digests']) * index['digests'].itemsize + len(index['pos']) * index['pos'].itemsize
+
+# ── FILE PROFILE ───────────────────────────────────────────────
+# Keyword theo vai trò cột — thứ tự = thứ tự ưu tiên khi dò header
+REF_KWS = ['số gd', 'so but toan', 'số giao dịch', 'reference', 'số tham chiếu']
+DATE_KWS = ['ngày giao dịch', 'ngay giao dich', 'ngày hạch toán', 'transaction date']
+DEDUP_AMOUNT_KWS = ['tiền', 'debit', 'credit', 'nợ', 'có', 'rút', 'gửi', 'no/', 'co/']
+AMOUNT_KWS = ['tiền', 'nợ', 'có', 'debit', 'credit', 'dư', 'balance',
+              'rút', 'gửi', 'no/', 'co/', 'amount']
+# Vai trò cột cho Phase 2 (thứ tự = thứ tự if/elif)
+TX_ROLE_KWS = [
+    ('desc',         ['nội dung','diễn giải','mô tả','description','transactions in detail']),
+    ('debit',        ['rút ra','ghi nợ','nợ/ debit','no/debit','debit']),
+    ('credit',       ['gửi vào','ghi có','có / credit','co/credit','credit']),
+    ('balance',      ['số dư','balance']),
+    ('ref',          ['số gd','so but toan','transaction number','số giao dịch','số tham chiếu','reference']),
+    ('counter_name', ['tên tk','corresponsive name','tên tài khoản đối']),
+    ('counter_acct', ['tk đối','corresponsive account','số tài khoản đối']),
+]
+TX_AMOUNT_ROLES = ('debit', 'credit', 'balance')
+
+def _first_value(row, groups):
+    """Giá trị đầu tiên khác rỗng theo nhóm cột (mỗi keyword 1 nhóm)"""
+    n = len(row)
+    for cols in groups:
+        for i in cols:
+            if i < n:
+                v = str(row[i] or '').strip()
+                if v: return v
+                break
+    return ''
+
+def build_column_plan(headers, bank_id=None):
+    """Compile header → index cột theo vai trò, dùng lại cho mọi data row
+    (keyword theo 'columns' của bank profile nếu có khai báo)"""
+    kw = BANKS[bank_id].get('columns', {}) if bank_id in BANKS else {}
+    h = [str(c or '').lower() for c in headers]
+    h_p2 = [str(c or '').replace('\n', ' ').strip().lower() for c in headers]
+
+    tx_roles = []
+    for i, hh in enumerate(h_p2):
+        for role, kws in kw.get('tx_roles', TX_ROLE_KWS):
+            if any(k in hh for k in kws):
+                tx_roles.append((i, role))
+                break
+
+    ref_groups = [tuple(i for i, hh in enumerate(h) if k in hh) for k in kw.get('ref', REF_KWS)]
+    date_groups = [tuple(i for i, hh in enumerate(h) if k in hh) for k in kw.get('date', DATE_KWS)]
+    cols = {role: i for i, role in tx_roles}
+    date_cols = [i for g in date_groups for i in g]
+    cols['date'] = date_cols[0] if date_cols else None
+    amount_mask = [any(k in hh for k in kw.get('amount', AMOUNT_KWS)) for hh in h]
+
+    return {
+        'ref_groups': ref_groups,
+        'date_groups': date_groups,
+        'dedup_amount_cols': [i for k in kw.get('dedup_amount', DEDUP_AMOUNT_KWS) for i, hh in enumerate(h) if k in hh],
+        'amount_mask': amount_mask,
+        'amount_cols': [i for i, m in enumerate(amount_mask) if m],
+        'tx_roles': tx_roles,
+        'cols': cols,
+    }
+
+HEAD_ROWS = 15           # số dòng đầu dùng cho detect_bank / get_account_no
+HEADER_SCAN_ROWS = 100   # dò header tối đa trong ngần này dòng đầu
+
+def build_file_profile(rows):
+    """FileProfile: nhận dạng 1 lần / file (bank, số TK, header, column plan)
+
+    `rows` có thể là iterator: chỉ đọc 15 dòng đầu để nhận dạng bank/số TK,
+    rồi đọc tiếp tới khi gặp header (tối đa HEADER_SCAN_ROWS dòng).
+    """
+    it = iter(rows)
+    head = list(islice(it, HEAD_ROWS))
+    with timer('detect_bank'):
+        bank_id = detect_bank(head)
+    profile = {'bank_id': bank_id, 'account_no': None, 'h_idx': -1,
+               'meta_rows': None, 'headers': None, 'plan': None,
+               'date_col': None, 'date_fmt': None}
+    if not bank_id:
+        return profile
+    profile['account_no'] = get_account_no(head, bank_id)
+    scanned = head + list(islice(it, HEADER_SCAN_ROWS - HEAD_ROWS))
+    with timer('find_header_row'):
+        h_idx = find_header_row(scanned, bank_id)
+    if h_idx >= 0:
+        profile['h_idx'] = h_idx
+        profile['meta_rows'] = scanned[:h_idx]
+        profile['headers'] = scanned[h_idx]
+        profile['plan'] = build_column_plan(scanned[h_idx], bank_id)
+        sample = scanned[h_idx + 1:]
+        if len(sample) < DATE_SAMPLE_ROWS:
+            sample += list(islice(it, DATE_SAMPLE_ROWS - len(sample)))
+        profile['date_col'], profile['date_fmt'] = detect_date_format(sample[:DATE_SAMPLE_ROWS])
+    return profile
+
+def probe_file(uploaded_file):
+    """Nhận dạng file mà không đọc hết data rows"""
+    rows = iter_rows(uploaded_file)
+    try:
+        return build_file_profile(rows)
+    finally:
+        rows.close()
+
+# ── CSV STREAMING ──────────────────────────────────────────────
+CSV_HEAD_BYTES = 64 * 1024   # mẫu đầu file để dò encoding + separator
+
+def sniff_csv_encoding(head):
+    """Dò encoding 1 lần từ đoạn đầu file (utf-8 có/không BOM, fallback latin-1)"""
+    try:
+        codecs.getincrementaldecoder('utf-8-sig')().decode(head, final=False)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+def sniff_csv_separator(sample):
+    """Chọn ; hoặc , 1 lần cho cả file: separator cho số cột ổn định nhất"""
+    lines = [l for l in sample.splitlines()[:200] if l.strip()]
+    scores = {}
+    for sep in (';', ','):
+        counts = {}
+        for line in lines:   # từng dòng riêng: quote mở không kéo sang dòng sau
+            r = next(csv.reader([line], delimiter=sep, skipinitialspace=True), [])
+            if len(r) > 1:
+                counts[len(r)] = counts.get(len(r), 0) + 1
+        scores[sep] = max(counts.values()) if counts else 0
+    return ';' if scores[';'] > scores[','] else ','
+
+def iter_csv_rows(uploaded_file):
+    """Đọc CSV dạng stream → yield từng row (list, field đã strip)
+
+    Decode tăng dần qua TextIOWrapper + module csv (C), không load cả file.
+    Dòng trống → [] như parser cũ; row lệch số cột giữ nguyên độ dài.
+    Như parser cũ, quote không kéo sang dòng sau: record nào trải nhiều dòng
+    vật lý (quote mở không đóng) thì parse lại từng dòng riêng.
+    """
+    uploaded_file.seek(0)
+    head = uploaded_file.read(CSV_HEAD_BYTES)
+    uploaded_file.seek(0)
+    encoding = sniff_csv_encoding(head)
+    sep = sniff_csv_separator(head.decode(encoding, errors='ignore'))
+
+    def fields(r):
+        if len(r) == 1 and not r[0].strip():
+            return []
+        return [c.strip() for c in r]
+
+    # Dòng vật lý của record đang đọc (csv.reader không đọc trước)
+    lines = []
+    def physical(text):
+        for line in text:
+            lines.append(line)
+            yield line
+
+    # errors='replace': byte lỗi nằm ngoài đoạn mẫu không làm hỏng cả file
+    text = TextIOWrapper(uploaded_file, encoding=encoding, errors='replace', newline='')
+    try:
+        for r in csv.reader(physical(text), delimiter=sep, skipinitialspace=True):
+            if len(lines) == 1:
+                lines.clear()
+                yield fields(r)
+                continue
+            span = lines[:]
+            lines.clear()
+            for line in span:
+                yield fields(next(csv.reader([line], delimiter=sep, skipinitialspace=True), []))
+    finally:
+        text.detach()
+
+def iter_xls_rows(uploaded_file):
+    """Excel 97-2003 (xlrd, on_demand) → yield từng row, đủ ncols như trước"""
+    import xlrd
+    uploaded_file.seek(0)
+    wb = xlrd.open_workbook(file_contents=uploaded_file.read(), on_demand=True)
+    try:
+        ws = wb.sheet_by_index(0)
+        ncols = ws.ncols
+        for i in range(ws.nrows):
+            r = ws.row_values(i)
+            if len(r) < ncols:
+                r += [''] * (ncols - len(r))
+            yield r
+    finally:
+        wb.release_resources()
+
+def iter_xlsx_rows(uploaded_file):
+    """xlsx (openpyxl read_only) → yield từng row, không dựng cả cell graph"""
+    import openpyxl
+    uploaded_file.seek(0)
+    wb = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        # read_only tin tag <dimension>; file không do Excel xuất hay ghi sai (vd. "A1")
+        # → bỏ tag, đọc theo dữ liệu thật; vẫn pad tới số cột khai báo như trước
+        width = ws.max_column or 0
+        ws.reset_dimensions()
+        for row in ws.iter_rows(values_only=True):
+            row = list(row)
+            if len(row) < width:
+                row += [None] * (width - len(row))
+            yield row
+    finally:
+        wb.close()
+
+def iter_rows(uploaded_file):
+    """Đọc file xlsx/xls/csv dạng stream → iterator of rows"""
+    name = uploaded_file.name.lower()
+    if name.endswith('.csv'):
+        return iter_csv_rows(uploaded_file)
+    elif name.endswith('.xls'):
+        return iter_xls_rows(uploaded_file)
+    else:
+        return iter_xlsx_rows(uploaded_file)
+
+def iter_data_rows(uploaded_file, profile):
+    """Data rows (sau header) của 1 file đã probe"""
+    return islice(iter_rows(uploaded_file), profile['h_idx'] + 1, None)
+
+def read_file(uploaded_file):
+    """Đọc file xlsx/xls/csv → list of rows"""
+    with timer('read_file'):
+        rows = list(iter_rows(uploaded_file))
+    add_count('read_file.rows', len(rows))
+    return rows
+
+# ── PROCESS POOL ───────────────────────────────────────────────
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+def pool_context():
+    """mp context cho process pool: 'forkserver' (hoặc 'spawn') — không fork process
+    đang chạy nhiều thread (server Streamlit), fork như vậy dễ deadlock"""
+    if 'forkserver' in mp.get_all_start_methods():
+        return mp.get_context('forkserver')
+    return mp.get_context('spawn')
+
+@contextmanager
+def pool_launch():
+    """Bọc đoạn submit vào pool (worker spawn/forkserver khởi động lúc submit).
+
+    Process con nạp lại __main__.__file__ của cha; với Streamlit đó là app.py → chạy
+    lại cả UI trong mỗi worker. Worker chỉ cần bank_merge nên tạm thay __main__ bằng
+    module rỗng trong lúc khởi động. Chạy CLI (bank_merge là __main__) thì giữ nguyên
+    vì worker được pickle theo tên __main__."""
+    main = sys.modules.get('__main__')
+    if __name__ == '__main__' or getattr(main, '__file__', None) is None:
+        yield
+        return
+    stub = types.ModuleType('__main__')
+    sys.modules['__main__'] = stub
+    try:
+        yield
+    finally:
+        # session Streamlit khác có thể đã cài __main__ mới trong lúc đó → không ghi đè
+        if sys.modules.get('__main__') is stub:
+            sys.modules['__main__'] = main
+
+# ── OUTPUT ENGINE ──────────────────────────────────────────────
+OUTPUT_FORMATS = {
+    'xlsx':    {'label': 'Excel (.xlsx)', 'ext': 'xlsx',
+                'mime': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'},
+    'csv':     {'label': 'CSV (.csv)', 'ext': 'csv', 'mime': 'text/csv'},
+    'parquet': {'label': 'Parquet (.parquet)', 'ext': 'parquet',
+                'mime': 'application/vnd.apache.parquet'},
+}
+
+def _blank(r):
+    return [c if c is not None else '' for c in r]
+
+def write_xlsx(buf, meta_rows, header_row, data_rows, plan):
+    """openpyxl write_only: ghi thẳng từng row, không giữ cell object"""
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    for r in meta_rows:
+        ws.append(_blank(r))
+    ws.append(_blank(header_row))
+    for row in data_rows:
+        ws.append(row)
+    wb.save(buf)
+
+def write_csv(buf, meta_rows, header_row, data_rows, plan):
+    """CSV utf-8 có BOM (Excel mở được tiếng Việt), giữ meta rows + header"""
+    text = TextIOWrapper(buf, encoding='utf-8-sig', newline='')
+    try:
+        w = csv.writer(text)
+        for r in meta_rows:
+            w.writerow(_blank(r))
+        w.writerow(_blank(header_row))
+        w.writerows(data_rows)
+    finally:
+        text.detach()
+
+def write_parquet(buf, meta_rows, header_row, data_rows, plan):
+    """Parquet (pandas): chỉ header + data, cột số tiền kiểu int64"""
+    import pandas as pd
+    data_rows = list(data_rows)
+    ncols = max([len(header_row)] + [len(r) for r in data_rows])
+    mask = plan['amount_mask']
+    columns, used = [], set()
+    for i in range(ncols):
+        name = str(header_row[i] or '').strip() if i < len(header_row) else ''
+        name = name or f'col_{i + 1}'
+        while name in used:
+            name += '_'
+        used.add(name)
+        columns.append(name)
+    is_amount = [i < len(mask) and mask[i] for i in range(ncols)]
+    pad = [0 if a else '' for a in is_amount]
+    records = [row + pad[len(row):] for row in data_rows]
+    df = pd.DataFrame(records, columns=columns)
+    for name, a in zip(columns, is_amount):
+        df[name] = df[name].astype('int64' if a else 'string')
+    df.to_parquet(buf, index=False)
+
+OUTPUT_WRITERS = {'xlsx': write_xlsx, 'csv': write_csv, 'parquet': write_parquet}
+
+def write_output(output_format, meta_rows, header_row, data_rows, plan):
+    """Ghi kết quả merge ra BytesIO theo định dạng đã chọn (data_rows: iterable)"""
+    buf = BytesIO()
+    OUTPUT_WRITERS[output_format](buf, meta_rows, header_row, data_rows, plan)
+    buf.seek(0)
+    return buf
+
+def collect_rows(all_rows_data, plan, bank_id, account_no):
+    """Engine theo dòng: lọc + dedup + normalize + sort
+    → (dates, rows đã sort, total_input, dup_count, dedup_bytes)"""
+    index = new_dedup_index()
+    all_data = []
+    total_input = 0
+    dup_count = 0
+    normalize = timed_fn('normalize_row', normalize_row)
+    dedup_key = timed_fn('dedup_key', dedup_key_tuple)
+    dedup_add = timed_fn('dedup_index', dedup_index_add)
+
+    # Row đã giữ chỉ còn bản normalize (ô số 0 → '0'): key nào không dựng lại
+    # được từ bản đó thì giữ riêng theo vị trí (hiếm: ref/ngày là ô số 0)
+    raw_keys = {}
+
+    def key_at(pos):
+        key = raw_keys.get(pos)
+        if key is None:
+            clean_row = all_data[pos][1]
+            key = dedup_key_tuple(clean_row, clean_row, plan)
+        return key
+
+    for src, fname, profile in all_rows_data:
+        if profile['h_idx'] < 0: continue
+
+        read_date = timed_fn('parse_date', make_date_reader(profile.get('date_col'), profile.get('date_fmt')))
+        for row in timed_iter('decode', iter_data_rows(src, profile)):
+            # Bỏ qua row rỗng
+            flat = ''.join([str(c or '') for c in row]).strip()
+            if not flat: continue
+
+            # Check có ngày hợp lệ không - cột ngày đã chốt trong FileProfile
+            d, _ = read_date(row)
+            if not d: continue
+
+            total_input += 1
+
+            # Normalize + dedup trên index compact
+            clean_row = normalize(row, plan)
+            key = dedup_key(row, clean_row, plan)
+            if not dedup_add(index, key, len(all_data), key_at):
+                dup_count += 1
+                continue
+            if key != dedup_key_tuple(clean_row, clean_row, plan):
+                raw_keys[len(all_data)] = key
+            all_data.append((d, clean_row))
+
+    # Sort theo ngày tăng dần
+    with timer('sort'):
+        all_data.sort(key=lambda x: x[0])
+    add_count('rows.input', total_input)
+    add_count('rows.duplicate', dup_count)
+    return ([d for d, _ in all_data], [r for _, r in all_data], total_input, dup_count,
+            dedup_index_bytes(index))
+
+# ── TX TABLE (Phase 1 → Phase 2) ───────────────────────────────
+TX_TEXT_COLUMNS = ['date', 'desc', 'ref', 'counter_name', 'counter_acct']
+
+def build_tx_table(data_rows, plan):
+    """Bảng giao dịch có kiểu, theo cột (DataFrame) dựng 1 lần lúc merge để
+    Phase 2 dùng thẳng — file xuất chỉ còn là artifact để tải về."""
+    import pandas as pd
+    import numpy as np
+    rows = iter(data_rows)
+    head = list(islice(rows, DATE_SAMPLE_ROWS))
+    read_date = make_date_reader(*detect_date_format(head))
+    tx_roles = plan['tx_roles']
+    cols = {c: [] for c in TX_TEXT_COLUMNS + list(TX_AMOUNT_ROLES)}
+    for row in chain(head, rows):
+        flat = ''.join([str(c or '') for c in row]).strip()
+        if not flat: continue
+
+        d, ci = read_date(row)
+        if not d: continue
+
+        tx = {'date': str(row[ci]).split('\n')[0].strip(), 'desc': '', 'debit': 0, 'credit': 0,
+              'balance': 0, 'ref': '', 'counter_name': '', 'counter_acct': ''}
+        n = len(row)
+        for i, role in tx_roles:
+            if i >= n: continue
+            if role in TX_AMOUNT_ROLES:
+                tx[role] = parse_amount(row[i])
+            else:
+                tx[role] = str(row[i] or '').strip()
+
+        if tx['debit'] == 0 and tx['credit'] == 0: continue
+        for c, v in tx.items():
+            cols[c].append(v)
+
+    table = pd.DataFrame({c: pd.Series(cols[c], dtype='int64' if c in TX_AMOUNT_ROLES else object)
+                          for c in cols})
+    is_thu = table['credit'] > 0
+    table['direction'] = np.where(is_thu, 'THU', 'CHI')
+    table['amount'] = table['credit'].where(is_thu, table['debit'])
+    return table
+
+def check_balance_chain(table):
+    """
+    Đối soát chuỗi số dư trên toàn bộ bảng giao dịch (vector hoá):
+    balance[i] == balance[i-1] + credit[i] - debit[i]
+    → DataFrame các điểm gãy (pos, date, ref, expected, balance, diff), rỗng nếu khớp
+    Bảng không có cột số dư (toàn 0) → None
+    """
+    import pandas as pd
+    import numpy as np
+    bal = table['balance'].to_numpy()
+    if len(bal) < 2 or not bal.any():
+        return None
+    expected = bal[:-1] + table['credit'].to_numpy()[1:] - table['debit'].to_numpy()[1:]
+    pos = np.flatnonzero(bal[1:] != expected) + 1
+    return pd.DataFrame({
+        'pos': pos + 1,
+        'date': table['date'].to_numpy()[pos],
+        'ref': table['ref'].to_numpy()[pos],
+        'expected': expected[pos - 1],
+        'balance': bal[pos],
+        'diff': bal[pos] - expected[pos - 1],
+    })
+
+def merge_group(info, output_format='xlsx', store_path=None, with_tx_table=True):
+    """Merge + dedup 1 nhóm bank_account → dict kết quả (hoặc {'error': ...})
+
+    store_path: merge tăng dần vào kho SQLite thay vì merge lại từ đầu.
+    with_tx_table: dựng bảng giao dịch cho Phase 2 (batch headless không cần).
+    """
+    bank_id = info['bank_id']
+    account_no = info['account_no']
+    all_rows_data = info['files']  # list of (file, filename, profile)
+
+    if not all_rows_data:
+        return None
+
+    # Lấy header + column plan từ file đầu tiên
+    _, first_name, first_profile = all_rows_data[0]
+    h_idx = first_profile['h_idx']
+    if h_idx < 0:
+        return {'error': f'Không tìm thấy header row trong file {first_name}'}
+
+    meta_rows = first_profile['meta_rows']
+    header_row = first_profile['headers']
+    plan = first_profile['plan']
+
+    if store_path:
+        with timer('merge_store'):
+            return merge_group_store(info, output_format, store_path, with_tx_table)
+
+    with timer('collect'):
+        dates, data_rows, total_input, dup_count, dedup_bytes = collect_rows(all_rows_data, plan, bank_id, account_no)
+
+    if not data_rows:
+        return {'error': 'Không có data sau khi lọc'}
+
+    # Date range cho tên file
+    min_date = dates[0]
+    max_date = dates[-1]
+    fmt = OUTPUT_FORMATS[output_format]
+    fname = f"{bank_id}_{account_no}_{min_date.strftime('%d%m%Y')}to{max_date.strftime('%d%m%Y')}.{fmt['ext']}"
+
+    tx_table = None
+    if with_tx_table:
+        with timer('build_tx_table'):
+            tx_table = build_tx_table(data_rows, plan)
+
+    # Build output (xlsx write_only / csv / parquet)
+    try:
+        with timer(f'write_output.{output_format}'):
+            buf = write_output(output_format, meta_rows, header_row, data_rows, plan)
+    except ImportError as e:
+        return {'error': f'Không ghi được {output_format}: {e}'}
+
+    return {
+        'filename': fname,
+        'data': buf,
+        'format': output_format,
+        'mime': fmt['mime'],
+        'tx_count': len(data_rows),
+        'dup_removed': dup_count,
+        'total_input': total_input,
+        'dedup_bytes': dedup_bytes,
+        'date_from': min_date.strftime('%d/%m/%Y'),
+        'date_to': max_date.strftime('%d/%m/%Y'),
+        'tx_table': tx_table,
+    }
+
+
+# ── MERGE STORE (SQLite) ───────────────────────────────────────
+MERGE_STORE_PATH = os.environ.get('MERGE_STORE_PATH', 'merge_store.db')
+
+MERGE_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS groups (
+    group_key   TEXT PRIMARY KEY,
+    bank_id     TEXT NOT NULL,
+    account_no  TEXT NOT NULL,
+    meta_json   TEXT NOT NULL,
+    header_json TEXT NOT NULL,
+    plan_json   TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    group_key TEXT NOT NULL,
+    digest    TEXT NOT NULL,
+    filename  TEXT,
+    merged_at TEXT,
+    PRIMARY KEY (group_key, digest)
+);
+CREATE TABLE IF NOT EXISTS tx (
+    seq       INTEGER PRIMARY KEY,
+    group_key TEXT NOT NULL,
+    dedup_key TEXT NOT NULL,
+    tx_date   TEXT NOT NULL,
+    row_json  TEXT NOT NULL,
+    UNIQUE (group_key, dedup_key)
+);
+CREATE INDEX IF NOT EXISTS tx_order ON tx (group_key, tx_date, seq);
+"""
+
+def open_merge_store(path):
+    """Mở (tạo nếu chưa có) kho SQLite lưu giao dịch đã merge theo bank_account"""
+    con = sqlite3.connect(path, timeout=60)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.executescript(MERGE_STORE_SCHEMA)
+    return con
+
+def _cell_json(c):
+    return c.isoformat() if hasattr(c, 'isoformat') else c
+
+def merge_group_store(info, output_format, store_path, with_tx_table=True):
+    """Merge tăng dần: chỉ file chưa từng merge mới được parse, chỉ giao dịch
+    chưa có key mới được insert; file xuất stream thẳng từ kho theo ngày."""
+    bank_id = info['bank_id']
+    account_no = info['account_no']
+    group_key = f"{bank_id}_{account_no}"
+    _, first_name, first_profile = info['files'][0]
+    current_header = _blank(first_profile['headers'])
+
+    con = open_merge_store(store_path)
+    try:
+        with con:
+            g = con.execute('SELECT meta_json, header_json, plan_json FROM groups WHERE group_key = ?',
+                            (group_key,)).fetchone()
+            if g is None:
+                meta_rows = [_blank(r) for r in first_profile['meta_rows']]
+                header_row, plan = current_header, first_profile['plan']
+                con.execute('INSERT INTO groups VALUES (?, ?, ?, ?, ?, ?)',
+                            (group_key, bank_id, account_no,
+                             json.dumps([[_cell_json(c) for c in r] for r in meta_rows], ensure_ascii=False),
+                             json.dumps([_cell_json(c) for c in header_row], ensure_ascii=False),
+                             json.dumps(plan)))
+            else:
+                meta_rows, header_row, plan = (json.loads(x) for x in g)
+                if [_cell_json(c) for c in current_header] != header_row:
+                    return {'error': f'Header file {first_name} khác với lịch sử đã lưu của {group_key}'}
+
+            total_input = 0
+            skipped_files = 0
+            inserted = 0
+            for src, fname, profile in info['files']:
+                if profile['h_idx'] < 0: continue
+                digest = file_digest(src)
+                if con.execute('SELECT 1 FROM files WHERE group_key = ? AND digest = ?',
+                               (group_key, digest)).fetchone():
+                    skipped_files += 1
+                    continue
+
+                read_date = make_date_reader(profile.get('date_col'), profile.get('date_fmt'))
+                def _new_rows():
+                    nonlocal total_input
+                    for row in iter_data_rows(src, profile):
+                        d, _ = read_date(row)
+                        if not d: continue
+                        total_input += 1
+                        yield (group_key, get_dedup_key(row, plan, bank_id, account_no),
+                               d.isoformat(),
+                               json.dumps(normalize_row(row, plan), ensure_ascii=False))
+
+                cur = con.executemany('INSERT OR IGNORE INTO tx (group_key, dedup_key, tx_date, row_json) '
+                                      'VALUES (?, ?, ?, ?)', _new_rows())
+                inserted += cur.rowcount
+                con.execute('INSERT INTO files VALUES (?, ?, ?, ?)',
+                            (group_key, digest, fname, datetime.now().isoformat(timespec='seconds')))
+
+        tx_count, min_d, max_d = con.execute(
+            'SELECT COUNT(*), MIN(tx_date), MAX(tx_date) FROM tx WHERE group_key = ?',
+            (group_key,)).fetchone()
+        if not tx_count:
+            return {'error': 'Không có data sau khi lọc'}
+        min_date = datetime.fromisoformat(min_d)
+        max_date = datetime.fromisoformat(max_d)
+        fmt = OUTPUT_FORMATS[output_format]
+        fname = f"{bank_id}_{account_no}_{min_date.strftime('%d%m%Y')}to{max_date.strftime('%d%m%Y')}.{fmt['ext']}"
+
+        def stored_rows():
+            return (json.loads(r[0]) for r in con.execute(
+                'SELECT row_json FROM tx WHERE group_key = ? ORDER BY tx_date, seq', (group_key,)))
+
+        tx_table = build_tx_table(stored_rows(), plan) if with_tx_table else None
+        try:
+            buf = write_output(output_format, meta_rows, header_row, stored_rows(), plan)
+        except ImportError as e:
+            return {'error': f'Không ghi được {output_format}: {e}'}
+    finally:
+        con.close()
+
+    return {
+        'filename': fname,
+        'data': buf,
+        'format': output_format,
+        'mime': fmt['mime'],
+        'tx_count': tx_count,
+        'dup_removed': total_input - inserted,
+        'total_input': total_input,
+        'new_rows': inserted,
+        'skipped_files': skipped_files,
+        'date_from': min_date.strftime('%d/%m/%Y'),
+        'date_to': max_date.strftime('%d/%m/%Y'),
+        'tx_table': tx_table,
+    }
+
+def merge_group_worker(item):
+    """Chạy trong process con: files dạng (tên, bytes, profile) → merge_group"""
+    info, output_format, store_path, with_tx_table, with_metrics = item
+    # Process con đo riêng từ đầu (bật theo cha), gửi kèm kết quả để cha cộng dồn
+    if with_metrics:
+        metrics_start()
+    else:
+        metrics_stop()
+    files = []
+    for name, data, profile in info['files']:
+        f = BytesIO(data)
+        f.name = name
+        files.append((f, name, profile))
+    res = merge_group(dict(info, files=files), output_format, store_path, with_tx_table)
+    m = metrics_stop()
+    if m and res is not None:
+        res = dict(res, metrics={'timers': m['timers'], 'counts': m['counts']})
+    return res
+
+def process_files(files_by_group, output_format='xlsx', workers=1, on_progress=None,
+                  store_path=None, with_tx_table=True):
+    """Merge + dedup files theo nhóm
+
+    Mỗi nhóm độc lập (dedup set, sort, output riêng) nên với workers > 1
+    các nhóm được merge song song trong ProcessPoolExecutor.
+    on_progress(key, done, total) được gọi mỗi khi 1 nhóm xong.
+    """
+    keys = list(files_by_group.keys())
+    done_results = {}
+
+    def _done(key, res):
+        if res and 'metrics' in res:
+            metrics_merge(res.pop('metrics'))
+        done_results[key] = res
+        if on_progress:
+            on_progress(key, len(done_results), len(keys))
+
+    if workers > 1 and len(keys) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(keys)), mp_context=pool_context()) as ex:
+            futures = {}
+            with pool_launch():
+                for key in keys:
+                    info = files_by_group[key]
+                    item = dict(info, files=[(name, src.getvalue(), profile)
+                                             for src, name, profile in info['files']])
+                    futures[ex.submit(merge_group_worker,
+                                      (item, output_format, store_path, with_tx_table,
+                                       metrics_on()))] = key
+            for fut in as_completed(futures):
+                _done(futures[fut], fut.result())
+    else:
+        for key in keys:
+            _done(key, merge_group(files_by_group[key], output_format, store_path, with_tx_table))
+
+    # Giữ đúng thứ tự nhóm như đầu vào
+    return {k: done_results[k] for k in keys if done_results[k] is not None}
+
+
+# ── PROBE (song song) ──────────────────────────────────────────
+def file_digest(uploaded_file):
+    """SHA-256 nội dung file upload (đọc thẳng buffer, không copy)"""
+    with uploaded_file.getbuffer() as view:
+        return hashlib.sha256(view).hexdigest()
+
+def file_cache_key(uploaded_file):
+    """Key cache: (SHA-256, đuôi file) — cùng nội dung khác tên vẫn trúng"""
+    return file_digest(uploaded_file), uploaded_file.name.lower().rsplit('.', 1)[-1]
+
+def probe_safe(uploaded_file):
+    """probe_file → (profile, lỗi) thay vì raise"""
+    try:
+        return probe_file(uploaded_file), None
+    except Exception as e:
+        return None, str(e)
+
+def probe_worker(item):
+    """Chạy trong process con: (tên file, bytes) → (profile, lỗi)"""
+    name, data = item
+    f = BytesIO(data)
+    f.name = name
+    return probe_safe(f)
+
+def probe_files(files, workers=1):
+    """Nhận dạng list file → list (profile, lỗi) theo đúng thứ tự đầu vào,
+    probe song song bằng ProcessPoolExecutor khi workers > 1"""
+    if workers > 1 and len(files) > 1:
+        items = [(f.name, f.getvalue()) for f in files]
+        with ProcessPoolExecutor(max_workers=min(workers, len(files)), mp_context=pool_context()) as ex:
+            with pool_launch():
+                futures = [ex.submit(probe_worker, item) for item in items]
+            return [f.result() for f in futures]
+    return [probe_safe(f) for f in files]
+
+# ── CLI ────────────────────────────────────────────────────────
+INPUT_EXTS = ('.xlsx', '.xls', '.csv')
+
+def load_dir(path):
+    """Thư mục sao kê → list file in-memory (BytesIO có .name), theo thứ tự tên"""
+    files = []
+    for name in sorted(os.listdir(path)):
+        if not name.lower().endswith(INPUT_EXTS) or name.startswith('~$'): continue
+        with open(os.path.join(path, name), 'rb') as fh:
+            f = BytesIO(fh.read())
+        f.name = name
+        files.append(f)
+    return files
+
+def group_files(files, workers=1):
+    """Probe + gom nhóm theo bank_account, bỏ file trùng nội dung → (groups, lỗi)"""
+    groups = {}
+    errors = []
+    seen_digests = {}
+    unique = []
+    for f in files:
+        digest = file_digest(f)
+        if digest in seen_digests:
+            errors.append(f"{f.name}: trùng nội dung với {seen_digests[digest]}, bỏ qua")
+            continue
+        seen_digests[digest] = f.name
+        unique.append(f)
+
+    for f, (profile, err) in zip(unique, probe_files(unique, workers)):
+        if err is not None:
+            errors.append(f"{f.name}: lỗi {err}")
+            continue
+        if not profile['bank_id']:
+            errors.append(f"{f.name}: không nhận dạng được ngân hàng")
+            continue
+        key = f"{profile['bank_id']}_{profile['account_no']}"
+        if key not in groups:
+            groups[key] = {'bank_id': profile['bank_id'], 'account_no': profile['account_no'], 'files': []}
+        groups[key]['files'].append((f, f.name, profile))
+    return groups, errors
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog='bank_merge',
+                                 description='Merge + dedup sao kê ngân hàng theo bank_account (không UI)')
+    ap.add_argument('input_dir', help='thư mục chứa file sao kê (xlsx, xls, csv)')
+    ap.add_argument('-o', '--output-dir', default='merged', help='thư mục ghi file đã merge')
+    ap.add_argument('-f', '--format', choices=list(OUTPUT_FORMATS), default='xlsx')
+    ap.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS)
+    ap.add_argument('--store', metavar='DB', help='merge tăng dần vào kho SQLite')
+    ap.add_argument('--report', metavar='JSON', help='ghi run report (timer + counter) ra file')
+    args = ap.parse_args(argv)
+
+    if args.report:
+        metrics_start()
+    with timer('probe_files'):
+        groups, errors = group_files(load_dir(args.input_dir), args.workers)
+    for e in errors:
+        print(f"⚠️ {e}", file=sys.stderr)
+    if not groups:
+        print("Không có file nào được nhận dạng.", file=sys.stderr)
+        return 1
+
+    def on_progress(key, done, total):
+        print(f"[{done}/{total}] {key}", file=sys.stderr)
+
+    with timer('process_files'):
+        results = process_files(groups, args.format, workers=args.workers, on_progress=on_progress,
+                                store_path=args.store, with_tx_table=False)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    failed = 0
+    for key, res in results.items():
+        if 'error' in res:
+            print(f"❌ {key}: {res['error']}")
+            failed += 1
+            continue
+        path = os.path.join(args.output_dir, res['filename'])
+        with open(path, 'wb') as out:
+            out.write(res['data'].getbuffer())
+        print(f"✅ {path}: {res['tx_count']} giao dịch | bỏ {res['dup_removed']} trùng | "
+              f"{res['date_from']} → {res['date_to']}")
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(metrics_report(metrics_stop()), f, ensure_ascii=False, indent=2)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,321 @@
+"""
+Benchmark pipeline merge trên sao kê tổng hợp (ACB, VCB, TCB, VTB, MB).
+
+- Sinh sao kê giả đúng meta rows / header mà detect_bank, get_account_no,
+  find_header_row nhận dạng; chia thành nhiều file chồng lấn + dòng trùng
+- Đo riêng từng stage: read_file, process_files, dựng bảng giao dịch Phase 2
+  → thời gian, throughput (rows/s), peak memory (tracemalloc, lượt chạy riêng)
+- Ghi kết quả (kèm git commit) vào file JSONL, so sánh với lần chạy trước
+  cùng cấu hình để thấy regression giữa các phiên bản
+
+    python bench.py --rows 10000 --formats xlsx,csv,xls
+    python bench.py --rows 1000000 --banks ACB --formats csv --no-memory
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import openpyxl
+
+BANKS = ['ACB', 'VCB', 'TCB', 'VTB', 'MB']
+FORMATS = ['xlsx', 'csv', 'xls']
+XLS_MAX_ROWS = 65536          # giới hạn 1 sheet của định dạng xls
+BENCH_RESULTS_PATH = os.environ.get('BENCH_RESULTS_PATH', 'bench_results.jsonl')
+
+DESC_WORDS = ['CK', 'THANH TOAN', 'TIEN DIEN', 'LUONG', 'HOA DON', 'IBFT', 'NAP TIEN',
+              'PHI DICH VU', 'CONG TY', 'KOI', 'EZ', 'VNSKY', 'HOAN TIEN', 'MUA HANG']
+COUNTER_NAMES = ['NGUYEN VAN A', 'TRAN THI B', 'CONG TY TNHH ABC', 'LE VAN C', 'CTY CP XYZ']
+
+
+# ── GENERATOR ──────────────────────────────────────────────────
+def _vn(n):
+    """1234567 → '1.234.567' (kiểu VietinBank)"""
+    return f'{n:,}'.replace(',', '.')
+
+# Mỗi bank: meta rows (chứa chữ ký + số TK), header, hàm tx → row
+BANK_SPECS = {
+    'ACB': {
+        'account_no': '3651368',
+        'meta': lambda acct: [['NGÂN HÀNG TMCP Á CHÂU'], ['BẢNG SAO KÊ GIAO DỊCH'],
+                              [f'Số tài khoản (Account No): {acct}'], []],
+        'header': ['Ngày hiệu lực', 'Số GD', 'Nội dung', 'Rút ra', 'Gửi vào', 'Số dư'],
+        'row': lambda t: [t['date'].strftime('%d/%m/%Y'), t['ref'], t['desc'],
+                          f"{t['debit']:,}" if t['debit'] else '',
+                          f"{t['credit']:,}" if t['credit'] else '', f"{t['balance']:,}"],
+        'footer': [[], ['Tổng cộng', '', '', '', '', '']],
+    },
+    'VCB': {
+        'account_no': '0721000656789',
+        'meta': lambda acct: [['SAO KÊ TÀI KHOẢN'], ['STATEMENT OF ACCOUNT'],
+                              ['Số tài khoản / Account number', acct], []],
+        'header': ['Ngày giao dịch\nTransaction Date', 'Số tham chiếu\nReference', 'Debit', 'Credit',
+                   'Số dư\nBalance', 'Mô tả\nDescription'],
+        # Ref trống ở 1/7 số dòng → dedup theo ngày + số tiền
+        'row': lambda t: [t['date'], t['ref'] if t['seq'] % 7 else '', t['debit'] or None,
+                          t['credit'] or None, t['balance'], t['desc']],
+        'footer': [],
+    },
+    'TCB': {
+        'account_no': '19035551234019',
+        'meta': lambda acct: [['TECHCOMBANK'], ['Tai khoan/Account', acct],
+                              ['Loai tien/Currency', 'VND'], []],
+        'header': ['Ngay giao dich/Transaction Date', 'So but toan/Reference',
+                   'Dien giai/Transactions in detail', 'No/Debit', 'Co/Credit', 'So du/Balance',
+                   'Ten TK doi ung/Corresponsive name'],
+        'row': lambda t: [t['date'].strftime('%d/%m/%Y %H:%M:%S'), t['ref'], t['desc'],
+                          t['debit'], t['credit'], t['balance'], t['counter_name']],
+        'footer': [],
+    },
+    'VTB': {
+        'account_no': '118002345678',
+        'meta': lambda acct: [['VIETINBANK'], ['LỊCH SỬ GIAO DỊCH'], ['Account No', acct], []],
+        'header': ['Accounting Date', 'Transaction Number', 'Description', 'Debit', 'Credit',
+                   'Balance', 'Corresponsive Name', 'Corresponsive Account'],
+        'row': lambda t: [t['date'].strftime('%d-%m-%Y %H:%M:%S'), t['ref'], t['desc'],
+                          _vn(t['debit']), _vn(t['credit']), _vn(t['balance']),
+                          t['counter_name'], t['counter_acct']],
+        'footer': [],
+    },
+    'MB': {
+        'account_no': '0801012345678',
+        'meta': lambda acct: [['MB BANK'], ['SAO KÊ CHI TIẾT'], ['Số tài khoản', acct], []],
+        'header': ['Ngày giao dịch', 'Số giao dịch', 'Nội dung', 'Số tiền ghi nợ', 'Số tiền ghi có', 'Số dư'],
+        'row': lambda t: [t['date'].strftime('%Y-%m-%d'), t['ref'], t['desc'],
+                          t['debit'], t['credit'], t['balance']],
+        'footer': [],
+    },
+}
+
+def gen_transactions(n, seed=0):
+    """Sổ giao dịch liền mạch n dòng (số dư nối chuỗi, ngày tăng dần, ref duy nhất)"""
+    r = random.Random(seed)
+    t0 = datetime(2024, 1, 1, 8, 0, 0)
+    per_day = max(1, n // 365)
+    balance = r.randint(10, 500) * 1_000_000
+    txs = []
+    for k in range(n):
+        debit = r.randint(1, 5000) * 1000 if r.random() < 0.5 else 0
+        credit = 0 if debit else r.randint(1, 5000) * 1000
+        balance += credit - debit
+        txs.append({
+            'seq': k,
+            'date': t0 + timedelta(days=k // per_day, seconds=(k % per_day) * 30),
+            'ref': f'FT{seed:02d}{k:09d}',
+            'desc': f"{r.choice(DESC_WORDS)} {r.choice(DESC_WORDS)} {k}",
+            'debit': debit, 'credit': credit, 'balance': balance,
+            'counter_name': r.choice(COUNTER_NAMES),
+            'counter_acct': str(r.randint(10**9, 10**10)),
+        })
+    return txs
+
+def split_files(txs, n_files, overlap, dup, seed=0):
+    """Chia sổ thành n_files đoạn liên tiếp, mỗi đoạn lấn `overlap` (tỷ lệ) sang đoạn
+    trước, và lặp lại `dup` (tỷ lệ) số dòng ngay trong file → list các list tx"""
+    r = random.Random(seed)
+    size = max(1, -(-len(txs) // n_files))
+    back = int(size * overlap)
+    parts = []
+    for i in range(n_files):
+        part = txs[max(0, i * size - back):(i + 1) * size]
+        if not part: continue
+        extra = [r.choice(part) for _ in range(int(len(part) * dup))]
+        part = sorted(part + extra, key=lambda t: t['seq'])
+        parts.append(part)
+    return parts
+
+def statement_rows(bank, txs, account_no=None):
+    spec = BANK_SPECS[bank]
+    meta = spec['meta'](account_no or spec['account_no'])
+    return meta + [spec['header']] + [spec['row'](t) for t in txs] + spec['footer']
+
+def _cell_text(c):
+    if c is None: return ''
+    if isinstance(c, datetime): return c.strftime('%d/%m/%Y')
+    return c
+
+def write_statement(rows, fmt):
+    """rows → bytes theo định dạng (xlsx write_only / csv utf-8-sig / xls qua xlwt)"""
+    buf = io.BytesIO()
+    if fmt == 'xlsx':
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet()
+        for r in rows:
+            ws.append(r)
+        wb.save(buf)
+    elif fmt == 'csv':
+        text = io.TextIOWrapper(buf, encoding='utf-8-sig', newline='')
+        w = csv.writer(text, delimiter=';')
+        for r in rows:
+            w.writerow([_cell_text(c) for c in r])
+        text.flush()
+        text.detach()
+    elif fmt == 'xls':
+        import xlwt
+        wb = xlwt.Workbook()
+        ws = wb.add_sheet('Sheet1')
+        for i, r in enumerate(rows):
+            for j, c in enumerate(r):
+                if c is not None:
+                    ws.write(i, j, _cell_text(c))
+        wb.save(buf)
+    return buf.getvalue()
+
+class BenchFile(io.BytesIO):
+    """File in-memory có .name như UploadedFile của Streamlit"""
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+
+
+# ── STAGES ─────────────────────────────────────────────────────
+def load_engine():
+    """Import engine merge (bank_merge — không kéo Streamlit)"""
+    import bank_merge
+    return bank_merge
+
+def build_groups(engine, files):
+    """Nhóm file theo bank_account như UI (probe_file)"""
+    groups = {}
+    for f in files:
+        p = engine.probe_file(f)
+        key = f"{p['bank_id']}_{p['account_no']}"
+        groups.setdefault(key, {'bank_id': p['bank_id'], 'account_no': p['account_no'],
+                                'files': []})['files'].append((f, f.name, p))
+    return groups
+
+def stage_read(engine, files, _):
+    return sum(len(engine.read_file(f)) for f in files)
+
+def stage_merge(engine, files, opts):
+    res = engine.process_files(build_groups(engine, files), opts.output, workers=opts.workers)
+    errors = [r['error'] for r in res.values() if 'error' in r]
+    if errors:
+        raise RuntimeError('; '.join(errors))
+    return sum(r['total_input'] for r in res.values())
+
+def stage_tx(engine, files, opts):
+    """Dựng bảng giao dịch Phase 2 từ data đã merge (không tính thời gian merge)"""
+    prepared = []
+    for info in build_groups(engine, files).values():
+        plan = info['files'][0][2]['plan']
+        _, rows, _, _, _ = engine.collect_rows(info['files'], plan, info['bank_id'], info['account_no'])
+        prepared.append((rows, plan))
+    t = time.perf_counter()
+    n = sum(len(engine.build_tx_table(rows, plan)) for rows, plan in prepared)
+    return n, time.perf_counter() - t
+
+STAGES = [('read_file', stage_read), ('process_files', stage_merge), ('tx_table', stage_tx)]
+
+def run_stage(fn, engine, files, opts, memory):
+    """→ (rows, giây, peak MB | None); peak đo ở lượt chạy riêng dưới tracemalloc"""
+    t = time.perf_counter()
+    out = fn(engine, files, opts)
+    elapsed = time.perf_counter() - t
+    rows, elapsed = out if isinstance(out, tuple) else (out, elapsed)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            fn(engine, files, opts)
+            peak = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+    return rows, elapsed, peak
+
+
+# ── REPORT ─────────────────────────────────────────────────────
+def git_version():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def load_previous(path, config):
+    """Lần chạy gần nhất cùng cấu hình trong file kết quả"""
+    prev = None
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                rec = json.loads(line)
+                if rec.get('config') == config:
+                    prev = rec
+    except (OSError, ValueError):
+        pass
+    return prev
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--rows', type=int, default=10000, help='số giao dịch duy nhất / bank')
+    ap.add_argument('--banks', default=','.join(BANKS))
+    ap.add_argument('--formats', default='xlsx,csv', help='định dạng file sinh ra: xlsx,csv,xls')
+    ap.add_argument('--files', type=int, default=3, help='số file sao kê / bank / định dạng')
+    ap.add_argument('--overlap', type=float, default=0.1, help='tỷ lệ chồng lấn giữa 2 file liền kề')
+    ap.add_argument('--dup', type=float, default=0.02, help='tỷ lệ dòng lặp trong cùng 1 file')
+    ap.add_argument('--workers', type=int, default=1)
+    ap.add_argument('--output', default='xlsx', choices=['xlsx', 'csv', 'parquet'])
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--no-memory', action='store_true', help='bỏ lượt đo peak memory')
+    ap.add_argument('--results', default=BENCH_RESULTS_PATH)
+    opts = ap.parse_args(argv)
+
+    banks = [b.strip().upper() for b in opts.banks.split(',') if b.strip()]
+    formats = [f.strip().lower() for f in opts.formats.split(',') if f.strip()]
+    config = {k: getattr(opts, k) for k in ('rows', 'files', 'overlap', 'dup', 'workers',
+                                            'output', 'seed')}
+    config.update(banks=banks, formats=formats)
+
+    engine = load_engine()
+    print(f"⏳ Sinh dữ liệu: {len(banks)} bank × {opts.rows:,} giao dịch × {formats}", file=sys.stderr)
+    files = []
+    for bi, bank in enumerate(banks):
+        parts = split_files(gen_transactions(opts.rows, seed=opts.seed + bi), opts.files, opts.overlap,
+                            opts.dup, seed=opts.seed + bi)
+        for fi, fmt in enumerate(formats):
+            # Mỗi định dạng 1 số TK riêng → 1 nhóm merge riêng
+            account_no = BANK_SPECS[bank]['account_no'][:-1] + str(fi)
+            for pi, part in enumerate(parts):
+                rows = statement_rows(bank, part, account_no)
+                if fmt == 'xls' and len(rows) > XLS_MAX_ROWS:
+                    print(f"⚠️ Bỏ {bank} xls: {len(rows):,} dòng > {XLS_MAX_ROWS}", file=sys.stderr)
+                    continue
+                try:
+                    data = write_statement(rows, fmt)
+                except ImportError as e:
+                    print(f"⚠️ Bỏ {fmt}: {e}", file=sys.stderr)
+                    break
+                files.append(BenchFile(f'{bank}_{pi}.{fmt}', data))
+
+    record = {'time': datetime.now().isoformat(timespec='seconds'), 'version': git_version(),
+              'config': config, 'input_bytes': sum(len(f.getvalue()) for f in files), 'stages': {}}
+    for name, fn in STAGES:
+        rows, elapsed, peak = run_stage(fn, engine, files, opts, not opts.no_memory)
+        record['stages'][name] = {'rows': rows, 'seconds': round(elapsed, 4),
+                                  'rows_per_s': round(rows / elapsed) if elapsed else None,
+                                  'peak_mb': round(peak, 1) if peak is not None else None}
+
+    prev = load_previous(opts.results, config)
+    print(f"{'stage':<14}{'rows':>12}{'seconds':>10}{'rows/s':>12}{'peak MB':>10}{'vs prev':>10}")
+    for name, s in record['stages'].items():
+        delta = ''
+        if prev and name in prev['stages'] and prev['stages'][name]['seconds']:
+            delta = f"{(s['seconds'] / prev['stages'][name]['seconds'] - 1) * 100:+.0f}%"
+        peak = f"{s['peak_mb']:.1f}" if s['peak_mb'] is not None else '-'
+        print(f"{name:<14}{s['rows']:>12,}{s['seconds']:>10.3f}{s['rows_per_s'] or 0:>12,}{peak:>10}{delta:>10}")
+    if prev:
+        print(f"(so với {prev['version']} lúc {prev['time']})")
+
+    with open(opts.results, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    return record
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""
+Backend Google Sheets giả, chạy cục bộ trong bộ nhớ — cùng bề mặt gspread mà app dùng
+(Spreadsheet.worksheet/worksheets/values_batch_get, Worksheet.get_all_values/row_values/
+get/batch_get/append_row/append_rows/acell/update_acell/batch_update).
+
+- Đếm mọi lời gọi API (stats) để đo / so sánh số round-trip
+- Giả lập độ trễ mỗi lời gọi và lỗi quota 429 (giới hạn request / phút, lỗi ngẫu nhiên)
+- Seed dữ liệu từ file JSON {tên sheet: [[cell, ...], ...]}
+
+Dùng trong app: GSHEET_BACKEND=fake:<file.json>[?latency=0.2&quota=60&error_rate=0.01]
+"""
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+from urllib.parse import parse_qsl
+
+import requests
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.utils import a1_range_to_grid_range, a1_to_rowcol
+
+DEFAULT_ROWS = 1000
+DEFAULT_COLS = 26
+
+
+def _render(v):
+    """Giá trị cell → chuỗi hiển thị như Sheets (định dạng số mặc định)"""
+    if v is None:
+        return ''
+    if isinstance(v, bool):
+        return 'TRUE' if v else 'FALSE'
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+
+def _api_error(status, message):
+    """APIError thật của gspread để code retry của app chạy đúng nhánh"""
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = json.dumps({'error': {'code': status, 'message': message}}).encode()
+    return APIError(resp)
+
+
+def _trim(rows):
+    """Bỏ cell rỗng cuối dòng + dòng rỗng cuối (giống ValueRange của API)"""
+    out = []
+    for row in rows:
+        row = list(row)
+        while row and row[-1] == '':
+            row.pop()
+        out.append(row)
+    while out and not out[-1]:
+        out.pop()
+    return out
+
+
+class FakeCell:
+    def __init__(self, row, col, value):
+        self.row, self.col, self.value = row, col, value
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, rows=None, row_count=DEFAULT_ROWS, col_count=DEFAULT_COLS):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self._cells = [[_render(v) for v in r] for r in (rows or [])]
+        self.row_count = max(row_count, len(self._cells))
+        self.col_count = max([col_count] + [len(r) for r in self._cells])
+
+    # ── nội bộ ──
+    def _call(self, name):
+        self.spreadsheet._call(name)
+
+    def _last_row(self):
+        n = len(self._cells)
+        while n and not any(self._cells[n-1]):
+            n -= 1
+        return n
+
+    def _read(self, a1):
+        g = a1_range_to_grid_range(a1)
+        r0 = g.get('startRowIndex', 0)
+        r1 = g.get('endRowIndex', self.row_count)
+        c0 = g.get('startColumnIndex', 0)
+        c1 = g.get('endColumnIndex', self.col_count)
+        return _trim(row[c0:c1] for row in self._cells[r0:r1])
+
+    def _write(self, row, col, value):
+        while len(self._cells) < row:
+            self._cells.append([])
+        cells = self._cells[row-1]
+        while len(cells) < col:
+            cells.append('')
+        cells[col-1] = _render(value)
+        self.row_count = max(self.row_count, row)
+        self.col_count = max(self.col_count, col)
+
+    # ── đọc ──
+    def get_all_values(self):
+        self._call('get_all_values')
+        with self.spreadsheet._lock:
+            return _trim(r[:] for r in self._cells)
+
+    def row_values(self, row):
+        self._call('row_values')
+        with self.spreadsheet._lock:
+            return _trim([self._cells[row-1][:]])[0] if row <= len(self._cells) and any(self._cells[row-1]) else []
+
+    def acell(self, label):
+        self._call('acell')
+        r, c = a1_to_rowcol(label)
+        with self.spreadsheet._lock:
+            v = self._cells[r-1][c-1] if r <= len(self._cells) and c <= len(self._cells[r-1]) else ''
+        return FakeCell(r, c, v or None)
+
+    def get(self, range_name):
+        self._call('get')
+        with self.spreadsheet._lock:
+            return self._read(range_name)
+
+    def batch_get(self, ranges):
+        self._call('batch_get')
+        with self.spreadsheet._lock:
+            return [self._read(r) for r in ranges]
+
+    # ── ghi ──
+    def append_row(self, values, value_input_option='RAW', **kwargs):
+        self._call('append_row')
+        self._append([values])
+
+    def append_rows(self, values, value_input_option='RAW', **kwargs):
+        self._call('append_rows')
+        self._append(values)
+
+    def _append(self, rows):
+        with self.spreadsheet._lock:
+            start = self._last_row()
+            for i, row in enumerate(rows):
+                for j, v in enumerate(row):
+                    self._write(start + i + 1, j + 1, v)
+
+    def update_acell(self, label, value):
+        self._call('update_acell')
+        r, c = a1_to_rowcol(label)
+        with self.spreadsheet._lock:
+            self._write(r, c, value)
+
+    def batch_update(self, data, **kwargs):
+        self._call('batch_update')
+        with self.spreadsheet._lock:
+            for item in data:
+                g = a1_range_to_grid_range(item['range'])
+                r0, c0 = g.get('startRowIndex', 0), g.get('startColumnIndex', 0)
+                for i, row in enumerate(item['values']):
+                    for j, v in enumerate(row):
+                        self._write(r0 + i + 1, c0 + j + 1, v)
+
+
+class FakeSpreadsheet:
+    """
+    Spreadsheet giả trong bộ nhớ.
+    latency: giây trễ mỗi lời gọi · quota_per_min: giới hạn request / 60s (None = không giới hạn)
+    error_rate: xác suất 1 lời gọi bị 429 ngẫu nhiên
+    """
+    def __init__(self, sheets=None, title='Fake Spreadsheet', id='fake',
+                 latency=0.0, quota_per_min=None, error_rate=0.0, seed=None):
+        self.title = title
+        self.id = id
+        self.latency = latency
+        self.quota_per_min = quota_per_min
+        self.error_rate = error_rate
+        self.stats = Counter()
+        self.errors = Counter()
+        self._lock = threading.RLock()
+        self._window = deque()
+        self._rng = random.Random(seed)
+        self._sheets = {}
+        for name, rows in (sheets or {}).items():
+            self._sheets[name] = FakeWorksheet(self, name, rows)
+
+    def _call(self, name):
+        """Đếm + trễ + quota cho 1 lời gọi API"""
+        with self._lock:
+            self.stats[name] += 1
+            now = time.monotonic()
+            while self._window and now - self._window[0] >= 60:
+                self._window.popleft()
+            over = self.quota_per_min is not None and len(self._window) >= self.quota_per_min
+            if not over:
+                self._window.append(now)
+            flaky = self.error_rate and self._rng.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if over or flaky:
+            self.errors[name] += 1
+            raise _api_error(429, 'Quota exceeded (fake)')
+
+    @property
+    def total_calls(self):
+        return sum(self.stats.values())
+
+    def reset_stats(self):
+        self.stats.clear()
+        self.errors.clear()
+
+    def snapshot(self):
+        """{tên sheet: lưới giá trị} — không tính là lời gọi API"""
+        with self._lock:
+            return {name: _trim(r[:] for r in ws._cells) for name, ws in self._sheets.items()}
+
+    def worksheets(self):
+        self._call('worksheets')
+        return list(self._sheets.values())
+
+    def worksheet(self, title):
+        self._call('worksheet')
+        if title not in self._sheets:
+            raise WorksheetNotFound(title)
+        return self._sheets[title]
+
+    def add_worksheet(self, title, rows=DEFAULT_ROWS, cols=DEFAULT_COLS):
+        self._call('add_worksheet')
+        with self._lock:
+            ws = self._sheets[title] = FakeWorksheet(self, title, row_count=rows, col_count=cols)
+        return ws
+
+    def values_batch_get(self, ranges, params=None):
+        self._call('values_batch_get')
+        out = []
+        with self._lock:
+            for rng in ranges:
+                name, _, a1 = rng.rpartition('!')
+                name = name[1:-1].replace("''", "'") if name.startswith("'") else name
+                if name not in self._sheets:
+                    raise _api_error(400, f'Unable to parse range: {rng}')
+                out.append({'range': rng, 'values': self._sheets[name]._read(a1)})
+        return {'spreadsheetId': self.id, 'valueRanges': out}
+
+
+def open_backend(spec):
+    """
+    'fake:<file.json>?latency=0.2&quota=60&error_rate=0.01' → FakeSpreadsheet
+    file JSON: {tên sheet: [[cell, ...], ...]}; bỏ trống file → spreadsheet rỗng
+    """
+    spec = spec.split(':', 1)[1] if ':' in spec else ''
+    path, _, query = spec.partition('?')
+    opts = dict(parse_qsl(query))
+    sheets = {}
+    if path:
+        with open(path, encoding='utf-8') as f:
+            sheets = json.load(f)
+    return FakeSpreadsheet(
+        sheets,
+        title=opts.get('title', f'Fake ({path or "trống"})'),
+        latency=float(opts.get('latency', 0)),
+        quota_per_min=int(opts['quota']) if 'quota' in opts else None,
+        error_rate=float(opts.get('error_rate', 0)),
+    )
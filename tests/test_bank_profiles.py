@@ -0,0 +1,147 @@
+"""Registry BANK_PROFILES + matcher signature 1 lượt phải cho cùng kết quả với
+luật if/elif cũ (detect_bank / get_account_no / find_header_row trước registry)."""
+import random
+import re
+
+import pytest
+
+import bank_merge as bm
+import bench
+
+
+# ── Luật cũ (tham chiếu) ───────────────────────────────────────
+def old_detect_bank(rows):
+    flat = ' '.join([str(c) for r in rows[:15] for c in r if c])
+    if 'BẢNG SAO KÊ GIAO DỊCH' in flat:
+        return 'ACB'
+    if 'SAO KÊ TÀI KHOẢN' in flat or 'STATEMENT OF ACCOUNT' in flat:
+        return 'VCB'
+    if 'so but toan' in flat.lower() and 'ngay giao dich' in flat.lower():
+        return 'TCB'
+    if 'VIETINBANK' in flat.upper() or 'efast' in flat.lower() or 'LỊCH SỬ GIAO DỊCH' in flat:
+        return 'VTB'
+    if 'MB BANK' in flat.upper() or 'MILITARY' in flat.upper():
+        return 'MB'
+    return None
+
+
+def old_get_account_no(rows, bank_id):
+    flat_rows = [' '.join([str(c) for c in r if c]) for r in rows[:15]]
+    if bank_id == 'ACB':
+        for line in flat_rows:
+            m = re.search(r'[Ss]ố tài khoản.*?:\s*(\d+)', line)
+            if m: return m.group(1)
+            m = re.search(r'[Tt]ài khoản số:\s*(\d+)', line)
+            if m: return m.group(1)
+    elif bank_id == 'VCB':
+        for r in rows[:10]:
+            for i, cell in enumerate(r):
+                if cell and ('tài khoản' in str(cell).lower() or 'account number' in str(cell).lower()):
+                    for j in range(i+1, len(r)):
+                        v = str(r[j] or '').strip()
+                        if re.match(r'^\d{8,}$', v): return v
+                    m = re.search(r'\d{8,}', str(cell))
+                    if m: return m.group(0)
+    elif bank_id == 'TCB':
+        if len(rows) > 1 and len(rows[1]) > 1:
+            return str(rows[1][1] or '').strip()
+    elif bank_id in ('VTB', 'MB'):
+        for r in rows[:15]:
+            for i, cell in enumerate(r):
+                if cell and ('account no' in str(cell).lower() or 'số tài khoản' in str(cell).lower()):
+                    if i+1 < len(r):
+                        m = re.search(r'\d{8,}', str(r[i+1] or ''))
+                        if m: return m.group(0)
+    return 'unknown'
+
+
+def old_find_header_row(rows, bank_id):
+    kws = {
+        'ACB': ['ngày hiệu lực', 'số gd'],
+        'VCB': ['debit', 'credit'],
+        'TCB': ['so but toan', 'no/debit'],
+        'VTB': ['accounting date', 'debit'],
+        'MB':  ['ngày giao dịch', 'số tiền'],
+    }
+    keywords = kws.get(bank_id, [])
+    for i, row in enumerate(rows):
+        flat = ' '.join([str(c or '').replace('\n',' ').replace('\t',' ').lower() for c in row])
+        if all(kw in flat for kw in keywords):
+            return i
+    return -1
+
+
+# ── Dữ liệu ────────────────────────────────────────────────────
+# Mảnh text: signature thật, biến thể hoa thường, và chuỗi ghép để 2 signature
+# chồng lấn / là tiền tố của nhau (case khó cho finditer không chồng lấn)
+FRAGMENTS = [
+    'BẢNG SAO KÊ GIAO DỊCH', 'bảng sao kê giao dịch', 'SAO KÊ TÀI KHOẢN', 'Statement of Account',
+    'STATEMENT OF ACCOUNT', 'SO BUT TOAN', 'so but toan', 'Ngay Giao Dich', 'VietinBank', 'eFAST',
+    'LỊCH SỬ GIAO DỊCH', 'Lịch sử giao dịch', 'mb bank', 'Military', 'MB BANKING',
+    'STATEMENT OF ACCOUNTS', 'SAO KÊ TÀI KHOẢN SỐ', 'Số tài khoản: 12345678', 'Tài khoản số: 99887766',
+    'Account No', '0123456789', 'số tài khoản đối', 'Account number 12345678901', 'ngày hiệu lực',
+    'số gd', 'debit', 'credit', 'no/debit', 'accounting date', 'ngày giao dịch', 'số tiền', 'xx', '',
+    None, 12345678,
+    'so but toangay giao dich', 'efastatement of account', 'SAO KÊ TÀI KHOẢNgay giao dich',
+    'EFASTATEMENT OF ACCOUNT', 'so but toaNGAY GIAO DICH', 'LỊCH SỬ GIAO DỊCHmilitary',
+    'vietinbankmb bank', 'BẢNG SAO KÊ TÀI KHOẢN',
+]
+BANK_IDS = ['ACB', 'VCB', 'TCB', 'VTB', 'MB', None, 'X']
+
+
+def _heads():
+    txs = bench.gen_transactions(50)
+    heads = [bench.statement_rows(b, txs, '123456789')[:100] for b in bench.BANKS]
+    rng = random.Random(7)
+    for _ in range(5000):
+        heads.append([[rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 4))]
+                      for _ in range(rng.randint(0, 18))])
+    return heads
+
+
+def test_registry_matches_old_rules():
+    mismatches = []
+    for rows in _heads():
+        bank_id = bm.detect_bank(rows)
+        if bank_id != old_detect_bank(rows):
+            mismatches.append(('detect_bank', rows))
+        for b in BANK_IDS:
+            if bm.get_account_no(rows, b) != old_get_account_no(rows, b):
+                mismatches.append(('get_account_no', b, rows))
+            if bm.find_header_row(rows, b) != old_find_header_row(rows, b):
+                mismatches.append(('find_header_row', b, rows))
+    assert mismatches[:3] == []
+
+
+def test_statement_heads_detected():
+    txs = bench.gen_transactions(5)
+    for b in bench.BANKS:
+        assert bm.detect_bank(bench.statement_rows(b, txs, '123456789')) == b
+
+
+# ── Matcher với registry tuỳ ý ─────────────────────────────────
+def naive_detect(profiles, rows):
+    """Tham chiếu: bank đầu tiên có 1 phương án đủ mọi chuỗi (so chuỗi trực tiếp)"""
+    flat = ' '.join([str(c) for r in rows[:15] for c in r if c])
+    for p in profiles:
+        for option in p['signature']:
+            if all((n[4:].lower() in flat.lower()) if n.startswith('(?i)') else (n in flat)
+                   for n in option):
+                return p['id']
+    return None
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_signature_matcher_against_naive(monkeypatch, seed):
+    # Chuỗi ngắn trên bảng chữ cái nhỏ → nhiều tiền tố / chồng lấn / chứa nhau
+    rng = random.Random(seed)
+    words = sorted({''.join(rng.choice('abA') for _ in range(rng.randint(1, 5))) for _ in range(12)})
+    profiles = [{'id': f'B{k}',
+                 'signature': [[('(?i)' if rng.random() < 0.3 else '') + rng.choice(words)
+                                for _ in range(rng.randint(1, 2))] for _ in range(rng.randint(1, 2))]}
+                for k in range(6)]
+    monkeypatch.setattr(bm, 'SIGNATURES', bm.compile_signatures(profiles))
+    for _ in range(2000):
+        rows = [[''.join(rng.choice('abAB ') for _ in range(rng.randint(0, 12)))]
+                for _ in range(rng.randint(0, 3))]
+        assert bm.detect_bank(rows) == naive_detect(profiles, rows), (profiles, rows)
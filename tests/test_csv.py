@@ -0,0 +1,34 @@
+"""iter_csv_rows: quote xử lý như parser cũ — không kéo sang dòng sau."""
+import io
+
+import bank_merge as bm
+
+
+def _rows(text):
+    f = io.BytesIO(text.encode('utf-8'))
+    f.name = 'acb.csv'
+    return list(bm.iter_csv_rows(f))
+
+
+def test_unterminated_quote_stays_on_its_line():
+    rows = _rows('Ngày;Số GD;Nội dung;Rút;Gửi;Số dư\r\n'
+                 '01/01/2024;R1;"CK a;b";1000;;8000\r\n'
+                 '02/01/2024;R2;"CK abc;2000;;7000\r\n'
+                 '\r\n'
+                 '03/01/2024;R3;x;;500;7500\r\n'
+                 '04/01/2024;R4;y;100;;7400\r\n')
+    assert rows == [
+        ['Ngày', 'Số GD', 'Nội dung', 'Rút', 'Gửi', 'Số dư'],
+        ['01/01/2024', 'R1', 'CK a;b', '1000', '', '8000'],
+        ['02/01/2024', 'R2', 'CK abc;2000;;7000'],
+        [],
+        ['03/01/2024', 'R3', 'x', '', '500', '7500'],
+        ['04/01/2024', 'R4', 'y', '100', '', '7400'],
+    ]
+
+
+def test_unterminated_quote_does_not_change_separator():
+    rows = _rows('"01/01/2024;R1;a;1000;;8000\n'
+                 '02/01/2024;R2;b;;500;8500\n')
+    assert rows == [['01/01/2024;R1;a;1000;;8000'],
+                    ['02/01/2024', 'R2', 'b', '', '500', '8500']]
@@ -0,0 +1,70 @@
+"""Dedup của collect_rows phải giữ đúng ngữ nghĩa key của get_dedup_key."""
+import io
+
+import openpyxl
+
+import bank_merge as bm
+
+META = [
+    ['NGÂN HÀNG TMCP Á CHÂU'],
+    ['BẢNG SAO KÊ GIAO DỊCH'],
+    ['Số tài khoản: 3651368'],
+]
+HEADER = ['Ngày hiệu lực', 'Số GD', 'Nội dung', 'Rút ra', 'Gửi vào', 'Số dư']
+
+
+def _xlsx(rows):
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    for r in META + [HEADER] + rows:
+        ws.append(r)
+    buf = io.BytesIO()
+    wb.save(buf)
+    buf.name = 'acb.xlsx'
+    return buf
+
+
+def _collect(rows):
+    f = _xlsx(rows)
+    profile = bm.probe_file(f)
+    assert profile['bank_id'] == 'ACB' and profile['h_idx'] >= 0
+    _, kept, total_input, dup_count, _ = bm.collect_rows([(f, f.name, profile)], profile['plan'],
+                                                          'ACB', '3651368')
+    return [r[2] for r in kept], total_input, dup_count
+
+
+def test_numeric_zero_ref_falls_back_to_date_and_amounts():
+    # Ref là ô số 0 = không có ref (như str(cell or '')) → key theo ngày + số tiền
+    descs, total_input, dup_count = _collect([
+        ['01/01/2024', 0, 'a', None, 100, 100],
+        ['02/01/2024', 0, 'b', None, 200, 300],
+        ['03/01/2024', 0, 'c', 50, None, 250],
+        ['03/01/2024', 'R4', 'd', 50, None, 200],
+    ])
+    assert (descs, total_input, dup_count) == (['a', 'b', 'c', 'd'], 4, 0)
+
+
+def test_numeric_zero_ref_duplicates_still_removed():
+    descs, total_input, dup_count = _collect([
+        ['01/01/2024', 0, 'a', None, 100, 100],
+        ['01/01/2024', 0, 'a (trùng ngày + tiền)', None, 100, 100],
+        ['01/01/2024', None, 'a (ref rỗng, trùng)', None, 100, 100],
+        ['01/01/2024', '0', 'ref chuỗi "0"', None, 100, 100],
+        ['02/01/2024', '0', 'ref chuỗi "0" (trùng)', None, 999, 999],
+    ])
+    assert (descs, total_input, dup_count) == (['a', 'ref chuỗi "0"'], 5, 3)
+
+
+def test_matches_get_dedup_key():
+    rows = [
+        ['01/01/2024', 0, 'a', None, 100, 100],
+        ['01/01/2024', 0.0, 'b', None, 100, 100],
+        ['01/01/2024', 'R1', 'c', None, 100, 100],
+        ['01/01/2024', 'R1', 'd', 5, None, 95],
+        ['02/01/2024', '', 'e', 5, None, 90],
+        ['02/01/2024', 0, 'f', 5, None, 85],
+    ]
+    profile = bm.probe_file(_xlsx(rows))
+    expected = len({bm.get_dedup_key(r, profile['plan'], 'ACB', '3651368') for r in rows})
+    descs, _, _ = _collect(rows)
+    assert len(descs) == expected == 3
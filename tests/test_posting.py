@@ -0,0 +1,200 @@
+"""Hạch toán theo lô (post_transactions / ledger_commit / bucket_take) trên backend giả fake_gsheet."""
+import time
+
+import pytest
+
+import app
+import fake_gsheet as fg
+
+RAW = 'Raw_ACB_Khoa'
+RAW_HEADER = ['Ngày', 'Nội dung', 'Ghi nợ', 'Ghi có', 'Số dư', 'Số GD']
+PROJECTS = ['P1', 'P2', 'P3']
+
+
+@pytest.fixture(autouse=True)
+def fast_sheets(monkeypatch):
+    """Bucket rộng + không chờ backoff, lô nhỏ để 1 sheet có nhiều chunk"""
+    monkeypatch.setattr(app, 'sheets_bucket', lambda: app.new_token_bucket(60000, 1000))
+    monkeypatch.setattr(app, 'SHEETS_BACKOFF_BASE', 0.0)
+    monkeypatch.setattr(app, 'POST_CHUNK_ROWS', 4)
+
+
+def spreadsheet():
+    # Account: số dư Raw_ACB_Khoa ở C4 (cell số bên phải tên sheet), Big Issue ở D86
+    acc = [[''] * 5 for _ in range(86)]
+    acc[3] = ['x', RAW, '1,000', '', '']
+    acc[85][3] = '0'
+    return fg.FakeSpreadsheet({RAW: [RAW_HEADER], 'Account': acc, **{p: [] for p in PROJECTS}})
+
+
+def tx(i, credit=0, debit=0):
+    return {'date': '01/01/2024', 'desc': f'd{i}', 'debit': debit, 'credit': credit, 'balance': 0,
+            'ref': f'R{i}', 'counter_name': '', 'counter_acct': '', 'direction': 'THU' if credit else 'CHI'}
+
+
+def items(n, big_issue_every=0):
+    out = []
+    for i in range(n):
+        t = tx(i, credit=100) if i % 3 else tx(i, debit=30)
+        if big_issue_every and i % big_issue_every == 0:
+            out.append((t, app.BIG_ISSUE_OPTION))
+        else:
+            out.append((t, PROJECTS[i % len(PROJECTS)]))
+    return out
+
+
+def delta(t):
+    return t['credit'] if t['direction'] == 'THU' else -t['debit']
+
+
+def account(ss):
+    acc = ss.snapshot()['Account']
+    return float(acc[3][2]), float(acc[85][3])
+
+
+def post(ss, its, workers=3):
+    return app.post_transactions(ss, RAW, its, workers=workers)
+
+
+def fail_on(monkeypatch, ws, name, calls, exc):
+    """Lời gọi thứ `calls` (tính từ 1) của ws.name ném exc, các lời gọi khác chạy thật"""
+    orig = getattr(ws, name)
+    n = [0]
+
+    def wrapped(*args, **kwargs):
+        n[0] += 1
+        if n[0] in calls:
+            raise exc
+        return orig(*args, **kwargs)
+    monkeypatch.setattr(ws, name, wrapped)
+    return n
+
+
+def test_order_kept_per_sheet_and_ledger_written_once():
+    ss = spreadsheet()
+    its = items(23, big_issue_every=5)
+    errors, unapplied, unposted = post(ss, its)
+    assert errors == [None] * 23 and unapplied == [] and unposted == []
+
+    snap = ss.snapshot()
+    assert [r[5] for r in snap[RAW][1:]] == [t['ref'] for t, _ in its]
+    for p in PROJECTS:
+        assert snap[p] == [[str(v) for v in app.project_row(t['date'], t['desc'], -delta(t))]
+                           for t, s in its if s == p]
+    raw_balance, d86 = account(ss)
+    assert raw_balance == 1000 + sum(delta(t) for t, _ in its)
+    assert d86 == sum(delta(t) for t, s in its if s == app.BIG_ISSUE_OPTION)
+    # Raw 23 dòng / lô 4 → 6 chunk; sheet dự án theo chunk; Account: 1 đọc lại + 1 ghi
+    per_project = [sum(1 for _, s in its if s == p) for p in PROJECTS]
+    assert ss.stats['append_rows'] == 6 + sum((k + 3) // 4 for k in per_project)
+    assert ss.stats['batch_get'] == 1 and ss.stats['batch_update'] == 1
+
+
+def test_raw_chunk_failure_keeps_appended_prefix(monkeypatch):
+    ss = spreadsheet()
+    fail_on(monkeypatch, ss.worksheet(RAW), 'append_rows', {2}, RuntimeError('boom'))
+    its = items(10)
+    errors, unapplied, unposted = post(ss, its)
+
+    # Lô 1 (dòng 0-3) đã vào Raw → vẫn ghi sheet dự án + Account; từ lô 2 trở đi là lỗi
+    assert errors[:4] == [None] * 4
+    assert all(e and 'boom' in e for e in errors[4:])
+    snap = ss.snapshot()
+    assert [r[5] for r in snap[RAW][1:]] == ['R0', 'R1', 'R2', 'R3']
+    assert sum(len(snap[p]) for p in PROJECTS) == 4
+    assert account(ss)[0] == 1000 + sum(delta(t) for t, _ in its[:4])
+    assert unapplied == [] and unposted == []
+
+
+def test_project_failure_still_books_raw_balance(monkeypatch):
+    ss = spreadsheet()
+    fail_on(monkeypatch, ss.worksheet('P1'), 'append_rows', {1, 2, 3}, RuntimeError('P1 down'))
+    its = items(9)
+    errors, unapplied, unposted = post(ss, its)
+
+    p1 = [i for i, (_, s) in enumerate(its) if s == 'P1']
+    assert [i for i, e in enumerate(errors) if e] == p1
+    # Dòng đã vào Raw → số dư raw cộng đủ 9 dòng, phần thiếu ở P1 trả về để ghi tay
+    assert len(ss.snapshot()[RAW]) == 10
+    assert account(ss)[0] == 1000 + sum(delta(t) for t, _ in its)
+    assert unapplied == []
+    assert [(u['row'], u['sheet'], u['desc'], u['amount']) for u in unposted] == \
+        [(i + 1, 'P1', its[i][0]['desc'], delta(its[i][0])) for i in p1]
+    assert all(u['reason'] == 'P1 down' for u in unposted)
+
+
+def test_append_retried_on_429_only(monkeypatch):
+    ss = spreadsheet()
+    raw = ss.worksheet(RAW)
+    calls = fail_on(monkeypatch, raw, 'append_rows', {1}, fg._api_error(429, 'quota'))
+    errors, _, _ = post(ss, items(3))
+    assert errors == [None] * 3 and calls[0] == 2
+    assert len(ss.snapshot()[RAW]) == 4
+
+    # 5xx sau khi có thể đã ghi → không gửi lại append (tránh ghi 2 lần)
+    ss = spreadsheet()
+    calls = fail_on(monkeypatch, ss.worksheet(RAW), 'append_rows', {1}, fg._api_error(503, 'backend'))
+    errors, _, _ = post(ss, items(3))
+    assert all(errors) and calls[0] == 1
+    assert len(ss.snapshot()[RAW]) == 1
+
+
+def test_read_retried_on_5xx(monkeypatch):
+    ss = spreadsheet()
+    calls = fail_on(monkeypatch, ss.worksheet(RAW), 'row_values', {1}, fg._api_error(503, 'backend'))
+    assert app.sheets_call(ss.worksheet(RAW).row_values, 1) == RAW_HEADER
+    assert calls[0] == 2
+
+
+def test_ledger_rebases_on_changed_number(monkeypatch):
+    ss = spreadsheet()
+    acc = ss.worksheet('Account')
+    orig = acc.batch_get
+
+    def changed_meanwhile(ranges):
+        acc.update_acell('C4', '5,000')   # người khác sửa sau khi dựng index
+        return orig(ranges)
+    monkeypatch.setattr(acc, 'batch_get', changed_meanwhile)
+    its = items(4)
+    errors, unapplied, _ = post(ss, its)
+    assert errors == [None] * 4 and unapplied == []
+    assert account(ss)[0] == 5000 + sum(delta(t) for t, _ in its)
+
+
+def test_ledger_reports_unapplied_when_cell_not_number(monkeypatch):
+    ss = spreadsheet()
+    acc = ss.worksheet('Account')
+    orig = acc.batch_get
+
+    def overwritten(ranges):
+        acc.update_acell('C4', 'xem lại')
+        return orig(ranges)
+    monkeypatch.setattr(acc, 'batch_get', overwritten)
+    its = items(4, big_issue_every=2)
+    errors, unapplied, _ = post(ss, its)
+
+    assert errors == [None] * 4
+    assert [(u['cell'], u['key'], u['delta']) for u in unapplied] == \
+        [('C4', RAW, sum(delta(t) for t, _ in its))]
+    # D86 vẫn là số → vẫn ghi; C4 giữ nguyên giá trị người dùng nhập
+    acc_grid = ss.snapshot()['Account']
+    assert acc_grid[3][2] == 'xem lại'
+    assert float(acc_grid[85][3]) == sum(delta(t) for t, s in its if s == app.BIG_ISSUE_OPTION)
+
+
+def test_account_unreadable_writes_nothing(monkeypatch):
+    ss = spreadsheet()
+    fail_on(monkeypatch, ss.worksheet('Account'), 'get_all_values', {1}, RuntimeError('no access'))
+    errors, unapplied, unposted = post(ss, items(3))
+    assert all('Account' in e for e in errors) and unapplied == [] and unposted == []
+    assert len(ss.snapshot()[RAW]) == 1
+
+
+def test_bucket_take_waits_for_refill():
+    bucket = app.new_token_bucket(rate_per_min=1200, burst=2)   # 20 token / giây
+    t = time.monotonic()
+    for _ in range(4):
+        app.bucket_take(bucket)
+    elapsed = time.monotonic() - t
+    # 2 token có sẵn, 2 token sau phải chờ nạp ~0.05 s mỗi cái
+    assert 0.08 <= elapsed < 1.0